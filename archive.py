@@ -0,0 +1,215 @@
+import atexit
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from os.path import join, dirname
+from config import ARCHIVE_QUEUE_SIZE, ARCHIVE_SYNC_BATCH
+from metrics import metrics
+
+# File of each archive directory keeping the next sequence number
+SEQUENCE_FILENAME = ".sequence"
+
+# Sequence numbers reserved at once, the sequence file is only written when a
+# block is used up
+SEQUENCE_BLOCK = 100
+
+# Sequence number at the start of the archived filenames
+INDEX_PATTERN = re.compile(r"^(\d+)-")
+
+
+def write_synced(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def rename_new(src: str, dst: str):
+    # Raises FileExistsError instead of replacing an existing 'dst'
+    if sys.platform == "win32":
+        # Never replaces the destination on Windows
+        os.rename(src, dst)
+    else:
+        os.link(src, dst)
+        os.remove(src)
+
+
+@contextmanager
+def locked(path: str):
+    # Exclusive lock on the file 'path' (created if missing), shared with the
+    # other processes, held until the end of the block
+    with open(path, "a+b") as f:
+        if sys.platform == "win32":
+            import msvcrt
+            # Locks the first byte, waiting up to 10 s for it
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def sync_directory(directory: str):
+    # Makes the renames durable, not possible (nor needed) on Windows
+    if sys.platform == "win32":
+        return
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Numbering of the files archived in a directory. The next free number is kept
+# in a file of the directory, so that naming a file never lists the directory
+# (this is only done once, when that file is missing). Numbers are reserved by
+# blocks, saved before being used: after a crash, some numbers are skipped but
+# none is given twice. The file is read again before reserving a block, under
+# a lock shared with the other processes (e.g. the standalone scripts): the
+# blocks they reserved are skipped.
+class Sequence:
+    def __init__(self, directory: str, filename: str = SEQUENCE_FILENAME):
+        self._directory = directory
+        self._path = join(directory, filename)
+        self._lock = threading.Lock()
+        self._next = None
+        self._reserved = None
+
+    def reserve(self, make_name) -> str:
+        # Name of the next file, made by 'make_name(index)'
+        with self._lock:
+            if self._next is None or self._next >= self._reserved:
+                with locked(self._path + ".lock"):
+                    self._next = max(self._next or 0, self._load())
+                    self._reserved = self._next + SEQUENCE_BLOCK
+                    tmp_path = self._path + ".tmp"
+                    write_synced(tmp_path, str(self._reserved).encode())
+                    os.replace(tmp_path, self._path)
+            index = self._next
+            self._next += 1
+            return make_name(index)
+
+    def _load(self) -> int:
+        try:
+            with open(self._path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            pass
+        # Missing or damaged: numbering continues after the existing files
+        last = -1
+        for name in os.listdir(self._directory):
+            match = INDEX_PATTERN.match(name)
+            if match:
+                last = max(last, int(match.group(1)))
+        return last + 1
+
+
+# Writes the archived files in the background, so that a slow disk never delays
+# the pictures or the prints. Each file is written to a temporary file, then
+# renamed: an archived file is either complete or missing, and an existing file
+# is never replaced (it is left as a temporary file instead). The files queued
+# together are synced together, before being renamed. When too many files are
+# waiting, write() blocks until the disk catches up. The files still queued
+# are written when the program exits.
+class ArchiveWriter(threading.Thread):
+    def __init__(self, max_pending: int = ARCHIVE_QUEUE_SIZE,
+                 batch_size: int = ARCHIVE_SYNC_BATCH):
+        super().__init__(daemon=True)
+        self._queue = queue.Queue(max_pending)
+        self._batch_size = batch_size
+        self._start_lock = threading.Lock()
+        self._writing = False
+
+    @property
+    def depth(self) -> int:
+        # Number of files waiting to be written
+        return self._queue.qsize()
+
+    def write(self, path: str, data: bytes):
+        with self._start_lock:
+            if not self._writing:
+                self._writing = True
+                self.start()
+                atexit.register(self.stop)
+        if self._queue.full():
+            print("Archive behind, {} files waiting".format(self.depth),
+                  file=sys.stderr)
+        self._queue.put((path, data))
+
+    def flush(self):
+        # Waits until all the queued files are written
+        if self.is_alive():
+            self._queue.join()
+
+    def stop(self):
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            running = None not in batch
+            start = time.perf_counter()
+            files = [item for item in batch if item is not None]
+            self._write_batch(files)
+            metrics.record("archive.batch", start, files=len(files),
+                           depth=self.depth)
+            for _ in batch:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write_batch(batch: list):
+        # All the files are written before the first sync, the disk can then
+        # flush them together
+        files = []
+        for path, data in batch:
+            f = None
+            try:
+                f = open(path + ".tmp", "wb")
+                f.write(data)
+                files.append((path, f))
+            except OSError as e:
+                if f is not None:
+                    f.close()
+                print("Failed to archive " + path + ": " + str(e),
+                      file=sys.stderr)
+        written = []
+        for path, f in files:
+            try:
+                with f:
+                    f.flush()
+                    os.fsync(f.fileno())
+                rename_new(path + ".tmp", path)
+                written.append(path)
+            except OSError as e:
+                print("Failed to archive " + path + ": " + str(e),
+                      file=sys.stderr)
+        for directory in {dirname(path) for path in written}:
+            try:
+                sync_directory(directory)
+            except OSError as e:
+                print("Failed to sync " + directory + ": " + str(e),
+                      file=sys.stderr)
+
+
+writer = ArchiveWriter()
@@ -0,0 +1,731 @@
+import argparse
+import math
+import statistics
+import time
+import sys
+import os
+from os.path import join, splitext
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from config import (FRAME_DIRECTORY, FRAMED_PICTURE_SIZE, FRAME_IMAGE_POS,
+                    CAMERA_PICTURE_SIZE)
+
+# Performance measurements of the picture pipeline, runnable without any
+# hardware: 'python benchmark.py <name>'. The frames from FRAME_DIRECTORY are
+# used when available, synthetic ones otherwise.
+
+
+def measure(func, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name: str, samples: list):
+    print("  {:<24} median {:8.2f} ms   min {:8.2f} ms".format(
+        name, statistics.median(samples) * 1000, min(samples) * 1000))
+
+
+def synthetic_picture(seed: int = 0,
+                      size: tuple = CAMERA_PICTURE_SIZE) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    w, h = size
+    # Smooth content compresses like a real picture, unlike pure noise
+    small = rng.integers(0, 256, (h // 8, w // 8, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize(size, Image.BILINEAR)
+
+
+def synthetic_frame(seed: int = 0, windows: list = None) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    color = tuple(int(c) for c in rng.integers(0, 256, 3))
+    frame = Image.new("RGBA", FRAMED_PICTURE_SIZE, color + (255,))
+    draw = ImageDraw.Draw(frame)
+    for x, y, w, h in windows or [FRAME_IMAGE_POS + CAMERA_PICTURE_SIZE]:
+        draw.rectangle((x, y, x + w - 1, y + h - 1), fill=(0, 0, 0, 0))
+    # Semi-transparent decorations, over and outside the picture windows
+    for _ in range(8):
+        cx, cy = (int(v) for v in rng.integers(0, FRAMED_PICTURE_SIZE))
+        r = int(rng.integers(20, 150))
+        draw.ellipse((cx - r, cy - r, cx + r, cy + r),
+                     fill=color + (int(rng.integers(30, 230)),))
+    # Opaque ones, with smooth edges like a drawn logo
+    logo = Image.new("L", FRAMED_PICTURE_SIZE, 0)
+    draw = ImageDraw.Draw(logo)
+    for _ in range(4):
+        cx, cy = (int(v) for v in rng.integers(0, FRAMED_PICTURE_SIZE))
+        r = int(rng.integers(100, 250))
+        draw.ellipse((cx - r, cy - r, cx + r, cy + r), fill=255)
+    logo = logo.filter(ImageFilter.GaussianBlur(3))
+    frame.paste(Image.new("RGBA", FRAMED_PICTURE_SIZE, color + (255,)),
+                (0, 0), logo)
+    return frame
+
+
+def load_frames(count: int) -> list:
+    if os.path.isdir(FRAME_DIRECTORY):
+        paths = sorted(join(FRAME_DIRECTORY, f)
+                       for f in os.listdir(FRAME_DIRECTORY)
+                       if splitext(f)[1].lower() == ".png")[:count]
+        if paths:
+            return [(p, Image.open(p).convert("RGBA")) for p in paths]
+    return [("synthetic-" + str(i), synthetic_frame(i)) for i in range(count)]
+
+
+def bench_montage(args):
+    from frames import Frame
+    from montage import Compositor, make_montage_pil
+    picture = synthetic_picture()
+    picture_array = np.asarray(picture.convert("RGBA"))
+    compositor = Compositor()
+    for name, image in load_frames(args.frames):
+        frame = Frame(name, 0, np.asarray(image))
+        expected = np.asarray(make_montage_pil(picture, image))
+        if not np.array_equal(compositor.compose([picture_array], frame),
+                              expected):
+            print(name + ": NumPy montage differs from PIL montage")
+            return 1
+        layer = frame.layer(FRAME_IMAGE_POS, picture_array.shape)
+        print(name + " (identical output, window tiles: {} transparent, {} "
+              "opaque, {} mixed, {} pixels blended)".format(
+                  *layer.tiles, len(layer.canvas_index)))
+        report("PIL", measure(
+            lambda: make_montage_pil(picture, image), args.repeat))
+        report("NumPy", measure(
+            lambda: compositor.compose([picture_array], frame), args.repeat))
+    return bench_burst_montage(args)
+
+
+def bench_burst_montage(args):
+    # Frames for several pictures: the pictures are decoded one after the
+    # other or in parallel, then fitted to their windows and composed
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from config import FRAME_BURST_WINDOWS, PRERENDER_WORKERS
+    from frames import Frame
+    from montage import Compositor, decode_picture, fit_picture
+    compositor = Compositor()
+    pool = ThreadPoolExecutor(PRERENDER_WORKERS)
+    for count, windows in sorted(FRAME_BURST_WINDOWS.items()):
+        image = synthetic_frame(count, windows)
+        frame = Frame("burst-" + str(count), 0, np.asarray(image))
+        data = []
+        for i in range(count):
+            jpeg = io.BytesIO()
+            synthetic_picture(i).save(jpeg, "JPEG", quality=90)
+            data.append(jpeg.getvalue())
+        pictures = [decode_picture(d) for d in data]
+        # Reference: the fitted pictures pasted by PIL
+        expected = Image.new("RGBA", image.size)
+        for picture, (x, y, w, h) in zip(pictures, windows):
+            expected.paste(Image.fromarray(fit_picture(picture, (w, h))),
+                           (x, y))
+        expected.paste(image, (0, 0), image)
+        if not np.array_equal(compositor.compose(pictures, frame),
+                              np.asarray(expected)):
+            print(frame.path + ": NumPy montage differs from PIL montage")
+            return 1
+        print(frame.path + " (identical output, {} windows)".format(count))
+        report("decode, one by one", measure(
+            lambda: [decode_picture(d) for d in data], args.repeat))
+        report("decode, in parallel", measure(
+            lambda: list(pool.map(decode_picture, data)), args.repeat))
+        report("fit and compose", measure(
+            lambda: compositor.compose(pictures, frame), args.repeat))
+    pool.shutdown()
+    return 0
+
+
+def bench_save(args):
+    import tempfile
+    from montage import make_montage_pil
+    name, frame = load_frames(1)[0]
+    montage = make_montage_pil(synthetic_picture(), frame)
+    print(name)
+    with tempfile.TemporaryDirectory() as directory:
+        for ext, params in ((".png", {"compress_level": 6}),
+                            (".png", {"compress_level": 1}),
+                            (".png", {"compress_level": 0}),
+                            (".bmp", {})):
+            filename = join(directory, "montage" + ext)
+            samples = measure(lambda: montage.save(filename, **params),
+                              args.repeat)
+            label = ext + " " + " ".join(
+                "{}={}".format(k, v) for k, v in params.items())
+            report(label, samples)
+            print("  {:<24} size   {:8.1f} MB".format(
+                "", os.path.getsize(filename) / 1024 / 1024))
+    return 0
+
+
+def bench_decode(args):
+    # Decoding of the camera JPEG for each use, at each size the camera can
+    # output, then the whole preview of a frame: from the full size montage
+    # (as before) or from pictures decoded for the preview
+    import io
+    from config import PREVIEW_SIZE
+    from frames import Frame, PREVIEW_SCALE
+    from montage import (Compositor, decode_picture, fit_picture,
+                         scaled_window)
+    from config import PREVIEW_DRAFT_SCALE
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QSize
+    from PyQt5.QtGui import QGuiApplication
+    from preview import preview_image
+    app = QGuiApplication(sys.argv)
+    name, image = load_frames(1)[0]
+    frame = Frame(name, 0, np.asarray(image))
+    window = frame.windows[0][2:]
+    size = QSize(*PREVIEW_SIZE)
+    compositor = Compositor()
+    for camera_size in ((1504, 1000), (2240, 1488), (3008, 2000)):
+        jpeg = io.BytesIO()
+        synthetic_picture(0, camera_size).save(jpeg, "JPEG", quality=90)
+        data = jpeg.getvalue()
+        print("Camera picture {}x{}, {:.1f} MB".format(
+            *camera_size, len(data) / 1024 / 1024))
+        for label, target in (
+                ("full size", None),
+                ("print", window),
+                ("preview",
+                 scaled_window(frame.windows[0], PREVIEW_SCALE)[2:]),
+                ("draft",
+                 scaled_window(frame.windows[0], PREVIEW_DRAFT_SCALE)[2:])):
+            decoded = decode_picture(data, target)
+            report("decode " + label, measure(
+                lambda: decode_picture(data, target), args.repeat))
+            print("  {:<24} {}x{}".format("", decoded.shape[1],
+                                          decoded.shape[0]))
+
+        def previous_preview():
+            picture = decode_picture(data)
+            return preview_image(compositor.compose([picture], frame), size)
+
+        def current_preview():
+            target = frame.preview.windows[0][2:]
+            picture = fit_picture(decode_picture(data, target), target)
+            return preview_image(compositor.compose([picture],
+                                                    frame.preview), size)
+
+        report("preview, full size", measure(previous_preview, args.repeat))
+        report("preview, reduced", measure(current_preview, args.repeat))
+    del app
+    return 0
+
+
+def measure_allocations(func, repeat: int) -> float:
+    # Average memory allocated (and released) by each call, in kB
+    import tracemalloc
+    func()
+    tracemalloc.start()
+    total = 0
+    for _ in range(repeat):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / repeat / 1024
+
+
+def bench_webcam(args):
+    import cv2
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtGui import QGuiApplication, QImage, QPixmap
+    from config import PREVIEW_SIZE
+    from webcam import WebcamCapture
+    app = QGuiApplication(sys.argv)
+    capture = WebcamCapture(0, PREVIEW_SIZE)
+    buffer = capture.buffers[0]
+    image = QImage(buffer, buffer.shape[1], buffer.shape[0],
+                   buffer.shape[1] * 3, QImage.Format_BGR888)
+
+    def previous_path(frame):
+        # Conversion done in the GUI thread before the capture thread
+        resized = cv2.resize(frame, PREVIEW_SIZE, interpolation=cv2.INTER_AREA)
+        flipped = cv2.flip(resized, 1)
+        rgb = cv2.cvtColor(flipped, cv2.COLOR_BGR2RGB)
+        QPixmap.fromImage(QImage(rgb, rgb.shape[1], rgb.shape[0],
+                                 QImage.Format_RGB888))
+
+    def current_path(frame):
+        capture._convert(frame, buffer)
+        return image
+
+    rng = np.random.default_rng(0)
+    for w, h in ((1280, 720), PREVIEW_SIZE):
+        frame = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        print("Webcam frame {}x{}".format(w, h))
+        for name, path in (("previous", previous_path),
+                           ("current", current_path)):
+            report(name, measure(lambda: path(frame), args.repeat))
+            print("  {:<24} alloc  {:8.1f} kB / frame".format(
+                "", measure_allocations(lambda: path(frame), args.repeat)))
+    del app
+    return 0
+
+
+def psnr(image: np.ndarray, reference: np.ndarray) -> float:
+    error = np.mean((image.astype(np.float64) - reference) ** 2)
+    return float("inf") if error == 0 else 10 * np.log10(255 ** 2 / error)
+
+
+def bench_resampling(args):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import Qt, QSize
+    from PyQt5.QtGui import QGuiApplication, QImage
+    from config import PREVIEW_SIZE
+    from montage import make_montage_pil, RESAMPLING_PRESETS
+    from printer import PrinterCaps, prepare_print_image
+    from preview import preview_image
+    app = QGuiApplication(sys.argv)
+    name, frame = load_frames(1)[0]
+    montage = make_montage_pil(synthetic_picture(), frame)
+    montage_array = np.asarray(montage)
+    size = QSize(*PREVIEW_SIZE)
+
+    def previous_preview():
+        # Crop, then scale by Qt
+        h, w = montage_array.shape[:2]
+        image = QImage(montage_array, w, h, w * 4, QImage.Format_RGBA8888)
+        cropped_w = round(h * size.width() / size.height())
+        image = image.copy((w - cropped_w) // 2, 0, cropped_w, h)
+        return image.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    def as_array(image) -> np.ndarray:
+        if isinstance(image, QImage):
+            data = image.constBits().asstring(image.sizeInBytes())
+            return np.frombuffer(data, np.uint8).reshape(
+                image.height(), image.bytesPerLine())[:, :image.width() * 4]
+        return np.asarray(image)
+
+    # Each preset, and its quality compared to the best one
+    print(name)
+    targets = [("preview", lambda preset: preview_image(
+        montage_array, size, preset))]
+    for w, h in (FRAMED_PICTURE_SIZE, (FRAMED_PICTURE_SIZE[0] * 2,
+                                       FRAMED_PICTURE_SIZE[1] * 2)):
+        targets.append(("print {}x{}".format(w, h),
+                        lambda preset, caps=PrinterCaps(w, h):
+                        prepare_print_image(montage, caps, preset)))
+    for target, make in targets:
+        print(target)
+        reference = as_array(make("best"))
+        for preset in RESAMPLING_PRESETS:
+            report(preset, measure(lambda: make(preset), args.repeat))
+            print("  {:<24} PSNR   {:8.2f} dB".format(
+                "", psnr(as_array(make(preset)), reference)))
+        if target == "preview":
+            report("previous (Qt)", measure(previous_preview, args.repeat))
+            print("  {:<24} PSNR   {:8.2f} dB".format(
+                "", psnr(as_array(previous_preview().convertToFormat(
+                    QImage.Format_RGBA8888)), reference)))
+    del app
+    return 0
+
+
+def booth_frames(directory: str, count: int, pictures: int = 1) -> str:
+    # Directory of frames accepted by the booth for the number of pictures:
+    # FRAME_DIRECTORY when it has some, synthetic ones written in 'directory'
+    # otherwise
+    from config import FRAME_BURST_WINDOWS
+    from frames import check_frame
+    if os.path.isdir(FRAME_DIRECTORY):
+        for f in os.listdir(FRAME_DIRECTORY):
+            try:
+                info = check_frame(join(FRAME_DIRECTORY, f), 0)
+                if len(info.windows) == pictures:
+                    return FRAME_DIRECTORY
+            except (OSError, ValueError):
+                pass
+    os.makedirs(directory)
+    windows = None
+    if pictures > 1:
+        windows = FRAME_BURST_WINDOWS[pictures]
+    for i in range(count):
+        frame = synthetic_frame(i, windows)
+        # Transparent edges, the decorations may not hide the whole windows
+        draw = ImageDraw.Draw(frame)
+        for x, y, w, h in windows or [FRAME_IMAGE_POS + CAMERA_PICTURE_SIZE]:
+            draw.rectangle((x, y, x + w - 1, y + h - 1), outline=(0, 0, 0, 0))
+        frame.save(join(directory, "synthetic-{}.png".format(i)))
+    return directory
+
+
+# Drives the booth like a guest: photo, preview, a few frame changes, then
+# print, and records the duration of each stage
+class BoothDriver:
+    STAGES = ("capture", "picture", "draft", "preview", "frame change",
+              "save", "print")
+
+    def __init__(self, widget, runs: int, cycles: int, done):
+        from PyQt5.QtCore import QTimer
+        from config import CAMERA_MAX_RETRY
+        self._widget = widget
+        self._runs = runs
+        self._cycles = cycles
+        self._done = done
+        self._max_retry = CAMERA_MAX_RETRY
+        self._run = 0
+        self._cycle = 0
+        self._start = 0.0
+        self._printing = False
+        self.samples = {stage: [] for stage in self.STAGES}
+        self.failures = {"camera": 0, "photo": 0, "print": 0, "timeout": 0}
+        self._watchdog = QTimer()
+        self._watchdog.setSingleShot(True)
+        self._watchdog.setInterval(60000)
+        self._watchdog.timeout.connect(self._on_timeout)
+        self._defer = lambda func: QTimer.singleShot(0, func)
+        widget.picture_taken.connect(self._on_picture_taken)
+        widget.print_done.connect(self._on_print_done)
+        widget.ready.connect(self._on_ready)
+
+    def _on_ready(self):
+        # The preview is made by the warm-up of the booth
+        preview = self._widget._preview
+        preview.picture_ready.connect(lambda: self._record("picture"))
+        preview.draft_ready.connect(lambda: self._record("draft"))
+        preview.preview_ready.connect(self._on_preview_ready)
+        preview.saved.connect(lambda *_: self._record("save"))
+        self.start()
+
+    def _elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def _record(self, stage: str):
+        self.samples[stage].append(self._elapsed())
+
+    def start(self):
+        if self._run >= self._runs:
+            self._watchdog.stop()
+            self._done()
+            return
+        self._run += 1
+        self._cycle = 0
+        self._printing = False
+        self._watchdog.start()
+        self._start = time.perf_counter()
+        self._widget._on_take_picture()
+
+    def _on_picture_taken(self, picture, error, session):
+        if session != self._widget._session:
+            # Late result of an abandoned photo, dropped by the booth
+            return
+        if error is None:
+            # The last picture of a burst ends the capture
+            if not self._widget._capturing:
+                self._record("capture")
+            return
+        self.failures["camera"] += 1
+        # Retried by the booth, up to CAMERA_MAX_RETRY
+        if self._widget._camera_retry_count >= self._max_retry:
+            self.failures["photo"] += 1
+            self._defer(self.start)
+
+    def _on_preview_ready(self):
+        if self._printing:
+            return
+        self._record("preview" if self._cycle == 0 else "frame change")
+        self._start = time.perf_counter()
+        if self._cycle < self._cycles:
+            self._cycle += 1
+            self._defer(self._widget._btn_quote.clicked.emit)
+        else:
+            self._printing = True
+            self._defer(self._widget._btn_printer.clicked.emit)
+
+    def _on_print_done(self, job):
+        if job.error is None:
+            self._record("print")
+        else:
+            self.failures["print"] += 1
+        self._defer(self.start)
+
+    def _on_timeout(self):
+        self.failures["timeout"] += 1
+        self.start()
+
+
+def bench_booth(args):
+    # End-to-end run of the booth on the simulated camera, webcam and
+    # printer, without display. The latencies and failure rates are those of
+    # the fake backends in config.py.
+    import tempfile
+    import config
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    with tempfile.TemporaryDirectory() as directory:
+        # Set before the booth modules read them
+        config.CAMERA_BACKEND = "fake"
+        config.WEBCAM_BACKEND = "fake"
+        config.PRINTER_BACKEND = "file"
+        config.PRINTER_PRINT_DURATION = 0
+        config.PRINTER_FILE_DIRECTORY = join(directory, "spool")
+        config.PRINTER_OUT_DIRECTORY = join(directory, "printed")
+        config.CAMERA_OUT_DIRNAME = join(directory, "pictures")
+        config.FRAME_OUT_FILENAME = join(directory, "latest-framed.png")
+        config.GALLERY_DIRECTORY = join(directory, "gallery")
+        config.METRICS_FILENAME = None
+        config.BURST_COUNT = args.burst
+        os.makedirs(config.PRINTER_OUT_DIRECTORY)
+        os.makedirs(config.CAMERA_OUT_DIRNAME)
+        config.FRAME_DIRECTORY = booth_frames(join(directory, "frames"),
+                                              args.frames, args.burst)
+        from PyQt5.QtWidgets import QApplication
+        import archive
+        import main
+        from metrics import metrics, percentile, format_summary
+        app = QApplication(sys.argv)
+        window = main.MainWindow()
+        window.show()
+        driver = BoothDriver(window.centralWidget(), args.repeat,
+                             args.cycles, app.quit)
+        app.exec()
+        archive.writer.flush()
+
+    print("Booth, {} photos of {} picture(s) with {} frame changes each"
+          .format(args.repeat, args.burst, args.cycles))
+    for stage in BoothDriver.STAGES:
+        samples = driver.samples[stage]
+        if samples:
+            print("  {:<24} p50 {:8.1f} ms   p95 {:8.1f} ms   max {:8.1f} ms"
+                  "   ({} samples)".format(
+                      stage, percentile(samples, 50) * 1000,
+                      percentile(samples, 95) * 1000, max(samples) * 1000,
+                      len(samples)))
+    print("  failures: " + ", ".join(
+        "{} {}".format(n, c) for n, c in driver.failures.items()))
+    print("Stages recorded by the booth")
+    print(format_summary(metrics.summary()))
+    return 0
+
+
+def bench_printers(args):
+    # Pools of simulated printers with different speeds and outages: each
+    # picture is submitted while the previous ones are printing. The print
+    # durations are those of real printers scaled down a hundred times.
+    import random
+    import tempfile
+    import threading
+    import config
+    config.METRICS_FILENAME = None
+    from metrics import percentile
+    from printer import FilePrinter, PrintJob, PrintQueue, prepare_print_image
+    from montage import make_montage_pil
+    name, frame = load_frames(1)[0]
+    montage = make_montage_pil(synthetic_picture(), frame)
+    arrival = 0.15
+    pools = (("1 printer", (0.5,)),
+             ("2 printers", (0.5, 0.5)),
+             ("3 printers, mixed", (0.4, 0.5, 0.8)))
+    for label, durations in pools:
+        random.seed(0)
+        with tempfile.TemporaryDirectory() as directory:
+            printers = [FilePrinter(join(directory, str(i)),
+                                    "printer " + str(i), duration,
+                                    delay=0.02, failure_rate=0.05,
+                                    outage_rate=0.05, outage_duration=2.0)
+                        for i, duration in enumerate(durations)]
+            done = []
+            finished = threading.Semaphore(0)
+
+            def on_done(job):
+                done.append((job, time.perf_counter()))
+                finished.release()
+
+            pool = PrintQueue(printers, on_done, status_interval=0.2)
+            pool.start()
+            image = prepare_print_image(montage, printers[0].caps())
+            start = time.perf_counter()
+            submitted = 0
+            for i in range(args.repeat):
+                time.sleep(max(0.0, start + i * arrival -
+                               time.perf_counter()))
+                try:
+                    pool.enqueue(PrintJob("", str(i) + ".png", image))
+                    submitted += 1
+                except RuntimeError:
+                    done.append((None, time.perf_counter()))
+            for _ in range(submitted):
+                finished.acquire()
+
+        printed = [(job, t) for job, t in done
+                   if job is not None and job.error is None]
+        waits = [t - job.submitted + job.worker.printer.print_duration
+                 for job, t in printed]
+        print("{}, {} pictures, one every {} s".format(
+            label, args.repeat, arrival))
+        if waits:
+            print("  {:<24} p50 {:8.2f} s    p95 {:8.2f} s    max {:8.2f} s"
+                  .format("until printed", percentile(waits, 50),
+                          percentile(waits, 95), max(waits)))
+        for printer in printers:
+            print("  {:<24} {} pictures".format(printer.name, sum(
+                job.worker.printer is printer for job, _ in printed)))
+        print("  {:<24} {} reassigned, {} failed, {} refused".format(
+            "", sum(len(job.failed_on) > 0 for job, _ in printed),
+            sum(job is not None and job.error is not None
+                for job, _ in done),
+            sum(job is None for job, _ in done)))
+    return 0
+
+
+# Started in a new process by bench_startup(), with the directory of the run
+STARTUP_SCRIPT = """
+import json
+import sys
+from os.path import join
+import config
+directory = sys.argv[1]
+config.CAMERA_BACKEND = "fake"
+config.WEBCAM_BACKEND = "fake"
+config.PRINTER_BACKEND = "file"
+config.PRINTER_FILE_DIRECTORY = join(directory, "spool")
+config.PRINTER_OUT_DIRECTORY = join(directory, "printed")
+config.CAMERA_OUT_DIRNAME = join(directory, "pictures")
+config.GALLERY_DIRECTORY = join(directory, "gallery")
+config.FRAME_DIRECTORY = sys.argv[2]
+config.METRICS_FILENAME = None
+import main
+from PyQt5.QtWidgets import QApplication
+from startup import profile
+app = QApplication(sys.argv)
+window = main.MainWindow()
+window.centralWidget().ready.connect(app.quit)
+window.show()
+app.exec()
+print("PHASES " + json.dumps(profile.phases()))
+"""
+
+
+def bench_startup(args):
+    # Starts of the booth on the simulated camera, webcam and printer, each
+    # one in a new process, until the welcome screen is shown and the booth
+    # is ready. The first start pays for the cold disk cache.
+    import json
+    import subprocess
+    import tempfile
+    from metrics import percentile
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    runs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        frames = booth_frames(join(directory, "frames"), args.frames)
+        for i in range(args.repeat):
+            run_directory = join(directory, str(i))
+            for name in ("printed", "pictures", "gallery"):
+                os.makedirs(join(run_directory, name))
+            output = subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT, run_directory,
+                 frames], cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env, capture_output=True, text=True).stdout
+            for line in output.splitlines():
+                if line.startswith("PHASES "):
+                    for phase, start, end, _ in json.loads(line[7:]):
+                        runs.setdefault(phase, []).append((start, end))
+    print("Startup, {} runs with {} frames".format(args.repeat, args.frames))
+    for phase, samples in sorted(runs.items(), key=lambda item: statistics
+                                 .median(end for _, end in item[1])):
+        ends = [end for _, end in samples]
+        took = [end - start for start, end in samples]
+        print("  {:<24} done at p50 {:7.1f} ms   took p50 {:7.1f} ms   "
+              "p95 {:7.1f} ms".format(phase, percentile(ends, 50),
+                                      percentile(took, 50),
+                                      percentile(took, 95)))
+    return 0
+
+
+def bench_gallery(args):
+    # Gallery of a long event: photos added one by one, then pages of
+    # thumbnails painted at random scroll positions, like a guest flicking
+    # through them. Compared with making the thumbnails of a page from the
+    # printed pictures.
+    import random
+    import tempfile
+    import config
+    config.METRICS_FILENAME = None
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtGui import QImage
+    from PyQt5.QtWidgets import QApplication
+    from gallery import Gallery, make_thumbnail
+    from montage import make_montage_pil
+    import main
+    app = QApplication(sys.argv)
+    name, frame = load_frames(1)[0]
+    montage = np.asarray(make_montage_pil(synthetic_picture(), frame))
+    thumbnail = make_thumbnail(montage)
+    with tempfile.TemporaryDirectory() as directory:
+        gallery = Gallery(directory)
+        adds = []
+        for i in range(args.photos):
+            start = time.perf_counter()
+            gallery.add("{}-00-00-00.png".format(i),
+                        np.roll(thumbnail, i, axis=1)).result()
+            adds.append(time.perf_counter() - start)
+        report("add a photo", adds)
+        gallery.close()
+        start = time.perf_counter()
+        gallery = Gallery(directory)
+        report("open the gallery", [time.perf_counter() - start])
+
+        view = main.GalleryView(None, gallery)
+        view.setFixedSize(*config.PREVIEW_SIZE)
+        view.refresh()
+        image = QImage(view.viewport().size(), QImage.Format_RGB32)
+        bar = view.verticalScrollBar()
+        random.seed(0)
+
+        def page():
+            bar.setValue(random.randrange(bar.maximum() + 1))
+            view.viewport().render(image)
+
+        report("page of thumbnails", measure(page, args.repeat))
+
+        # Thumbnails of a page made from the printed pictures instead
+        printed = join(directory, "printed.png")
+        Image.fromarray(montage).save(printed, compress_level=1)
+        cell_w, cell_h = (v + 2 * main.GalleryView.MARGIN
+                          for v in config.GALLERY_THUMBNAIL_SIZE)
+        count = (config.PREVIEW_SIZE[0] // cell_w *
+                 math.ceil(config.PREVIEW_SIZE[1] / cell_h))
+
+        def page_from_printed():
+            for _ in range(count):
+                with Image.open(printed) as picture:
+                    make_thumbnail(np.asarray(picture.convert("RGB")))
+
+        report("page from printed", measure(page_from_printed,
+                                            max(1, args.repeat // 10)))
+        gallery.close()
+    del app
+    return 0
+
+
+BENCHMARKS = {
+    "montage": bench_montage,
+    "decode": bench_decode,
+    "save": bench_save,
+    "webcam": bench_webcam,
+    "resampling": bench_resampling,
+    "booth": bench_booth,
+    "printers": bench_printers,
+    "gallery": bench_gallery,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=5,
+                        help="Maximum number of frames to use")
+    parser.add_argument("--cycles", type=int, default=3,
+                        help="Frame changes for each photo (booth)")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="Pictures taken for each photo (booth)")
+    parser.add_argument("--photos", type=int, default=3000,
+                        help="Photos in the gallery (gallery)")
+    arguments = parser.parse_args()
+    sys.exit(BENCHMARKS[arguments.benchmark](arguments))
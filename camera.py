@@ -1,12 +1,27 @@
-import win32com.client
-import pywintypes
+import threading
+import queue
 import time
-import shutil
 import sys
-import os
+import io
+import random
 from os.path import join
-from config import (CAMERA_MANUFACTURER, CAMERA_DEVICE_NAME,
-                    CAMERA_OUT_FILENAME, CAMERA_OUT_DIRNAME)
+from PIL import Image
+import archive
+from metrics import metrics
+from config import (CAMERA_BACKEND, CAMERA_MANUFACTURER, CAMERA_DEVICE_NAME,
+                    CAMERA_OUT_FILENAME, CAMERA_OUT_DIRNAME,
+                    CAMERA_PICTURE_SIZE, CAMERA_FAKE_DELAY,
+                    CAMERA_FAKE_TRANSFER_DELAY, CAMERA_FAKE_FAILURE_RATE,
+                    CAMERA_ARRIVAL_EVENTS, CAMERA_ARRIVAL_TIMEOUT,
+                    CAMERA_POLL_INTERVAL)
+
+# WIA identifiers
+WIA_COMMAND_TAKE_PICTURE = "{AF933CAC-ACAD-11D2-A093-00C04F72DC3C}"
+WIA_EVENT_ITEM_CREATED = "{4C8F4EF5-E14F-11D2-B326-00C04F68CE61}"
+
+# Interval between two deliveries of the device events, while waiting for a
+# picture (in seconds)
+EVENT_PUMP_INTERVAL = 0.01
 
 
 def to_hex(val, nbits):
@@ -30,48 +45,301 @@ def find_device(manager):
     raise RuntimeError("Target device not found")
 
 
-def take_picture(device) -> int:
-    try:
-        d = device.Connect()
-        picture_count = d.Items.count
-        d.ExecuteCommand("{AF933CAC-ACAD-11D2-A093-00C04F72DC3C}")
-        return picture_count
-    except pywintypes.com_error as e:
-        raise RuntimeError("[take_picture] Camera error: " + wia_err_to_str(e))
-    except Exception as e:
-        raise RuntimeError("[take_picture] Unexpected error: " + str(e))
+_pictures = archive.Sequence(CAMERA_OUT_DIRNAME)
+
+
+# Picture transferred from the camera: name on the camera and JPEG data
+class Picture:
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.data = data
+
+    def save(self, filename: str):
+        with open(filename, "wb") as f:
+            f.write(self.data)
+
+    def archive(self) -> str:
+        # Numbered, the camera may reuse its names. Written in the background.
+        name = _pictures.reserve(lambda index: str(index) + "-" + self.name)
+        archive.writer.write(join(CAMERA_OUT_DIRNAME, name), self.data)
+        return name
+
+
+# Wait for a new picture on the camera. The wait ends as soon as notify() is
+# called (device event) or when the 'has_arrived' check succeeds. This check is
+# polled with a short interval, doubled after each attempt up to a maximum.
+# The events delivered by 'pump', if given, are pumped continuously meanwhile,
+# on a short fixed tick.
+class PictureArrival:
+    def __init__(self, timeout: float = CAMERA_ARRIVAL_TIMEOUT,
+                 interval: tuple = CAMERA_POLL_INTERVAL):
+        self._timeout = timeout
+        self._min_interval, self._max_interval = interval
+        self._event = threading.Event()
+
+    def reset(self):
+        self._event.clear()
 
+    def notify(self):
+        self._event.set()
 
-def wait_for_picture(device, picture_count: int):
-    for _ in range(15):
-        time.sleep(1)
-        d = device.Connect()
-        if d.Items.count > picture_count:
+    def wait(self, has_arrived, pump=None):
+        start = time.monotonic()
+        interval = self._min_interval
+        next_check = start
+        while True:
+            if pump is not None:
+                pump()
+            if self._event.is_set():
+                break
+            now = time.monotonic()
+            if now >= next_check:
+                if has_arrived():
+                    break
+                next_check = now + interval
+                interval = min(interval * 2, self._max_interval)
+            remaining = start + self._timeout - now
+            if remaining <= 0:
+                raise RuntimeError("Timeout while waiting for picture")
+            delay = next_check - now
+            if pump is not None:
+                delay = min(delay, EVENT_PUMP_INTERVAL)
+            self._event.wait(min(delay, remaining))
+        self._event.clear()
+        print("Picture arrived after {:.3f} s".format(
+            time.monotonic() - start))
+
+
+class WiaCamera:
+    def __init__(self):
+        # Imported here so that the fake backend works without pywin32
+        import pythoncom
+        import pywintypes
+        import win32com.client
+        self._pythoncom = pythoncom
+        self._com_error = pywintypes.com_error
+        self._client = win32com.client
+        self._manager = None
+        self._device = None
+        # The events are only delivered when registered
+        self._events = False
+        self.arrival = PictureArrival()
+
+    def connect(self):
+        if self._device is not None:
             return
-    raise RuntimeError("Timeout while waiting for picture")
+        try:
+            # COM must be initialized in each thread using it
+            self._pythoncom.CoInitialize()
+            if CAMERA_ARRIVAL_EVENTS:
+                self._manager = self._client.DispatchWithEvents(
+                    "WIA.DeviceManager", self._events_handler())
+            else:
+                self._manager = self._client.Dispatch("WIA.DeviceManager")
+            device_info = find_device(self._manager)
+            if CAMERA_ARRIVAL_EVENTS:
+                self._register_events(device_info.DeviceID)
+            self._device = device_info.Connect()
+        except self._com_error as e:
+            raise RuntimeError("[connect] WIA error: " + wia_err_to_str(e))
 
+    def disconnect(self):
+        self._device = None
+        self._manager = None
+        self._events = False
 
-def get_picture(device):
-    try:
-        os.remove(CAMERA_OUT_FILENAME)
-        d = device.Connect()
-        last_pic = d.Items(d.Items.count)
-        name = str(last_pic.Properties["Item Name"].Value) + ".jpg"
-        wia_img = last_pic.Transfer()
-        wia_img.SaveFile(CAMERA_OUT_FILENAME)
-        shutil.copy(CAMERA_OUT_FILENAME, join(CAMERA_OUT_DIRNAME, name))
-    except pywintypes.com_error as e:
-        raise RuntimeError("[get_picture] WIA error: " + wia_err_to_str(e))
-    except Exception as e:
-        raise RuntimeError("[get_picture] Unexpected error: " + str(e))
+    def _events_handler(self):
+        arrival = self.arrival
+
+        class WiaEvents:
+            def OnEvent(self, event_id, device_id, item_id):
+                if event_id == WIA_EVENT_ITEM_CREATED:
+                    arrival.notify()
+
+        return WiaEvents
+
+    def _register_events(self, device_id):
+        try:
+            self._manager.RegisterEvent(WIA_EVENT_ITEM_CREATED, device_id)
+            self._events = True
+        except self._com_error as e:
+            # Polling the item count still works without events
+            print("Camera events not available: " + wia_err_to_str(e))
+
+    def take_picture(self) -> int:
+        try:
+            self.connect()
+            picture_count = self._device.Items.count
+            self.arrival.reset()
+            self._device.ExecuteCommand(WIA_COMMAND_TAKE_PICTURE)
+            return picture_count
+        except self._com_error as e:
+            raise RuntimeError("[take_picture] Camera error: " +
+                               wia_err_to_str(e))
+        except RuntimeError:
+            raise
+        except Exception as e:
+            raise RuntimeError("[take_picture] Unexpected error: " + str(e))
+
+    def wait_for_picture(self, picture_count: int):
+        try:
+            # WIA events are only delivered while pumping the COM messages
+            pump = None
+            if self._events:
+                pump = self._pythoncom.PumpWaitingMessages
+            self.arrival.wait(
+                lambda: self._device.Items.count > picture_count, pump)
+        except self._com_error as e:
+            raise RuntimeError("[wait_for_picture] Camera error: " +
+                               wia_err_to_str(e))
+
+    def get_picture(self) -> Picture:
+        try:
+            last_pic = self._device.Items(self._device.Items.count)
+            name = str(last_pic.Properties["Item Name"].Value) + ".jpg"
+            wia_img = last_pic.Transfer()
+            # Keep the file in memory, it is written to disk later on
+            return Picture(name, bytes(wia_img.FileData.BinaryData))
+        except self._com_error as e:
+            raise RuntimeError("[get_picture] WIA error: " + wia_err_to_str(e))
+        except Exception as e:
+            raise RuntimeError("[get_picture] Unexpected error: " + str(e))
+
+
+class FakeCamera:
+    def __init__(self, delay: float = CAMERA_FAKE_DELAY,
+                 transfer_delay: float = CAMERA_FAKE_TRANSFER_DELAY,
+                 failure_rate: float = CAMERA_FAKE_FAILURE_RATE):
+        self._delay = delay
+        self._transfer_delay = transfer_delay
+        self._failure_rate = failure_rate
+        self._count = 0
+        self._connected = False
+        self.arrival = PictureArrival()
+
+    def connect(self):
+        if not self._connected:
+            print("Fake camera connected")
+            self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def take_picture(self) -> int:
+        self.connect()
+        if random.random() < self._failure_rate:
+            raise RuntimeError("[take_picture] Fake camera error")
+        picture_count = self._count
+        self.arrival.reset()
+        # The picture appears on the camera after the configured delay
+        timer = threading.Timer(self._delay, self._on_picture_created)
+        timer.daemon = True
+        timer.start()
+        return picture_count
+
+    def _on_picture_created(self):
+        self._count += 1
+        self.arrival.notify()
+
+    def wait_for_picture(self, picture_count: int):
+        self.arrival.wait(lambda: self._count > picture_count)
+
+    def get_picture(self) -> Picture:
+        time.sleep(self._transfer_delay)
+        color = ((self._count * 67) % 256, (self._count * 131) % 256, 160)
+        image = Image.new("RGB", CAMERA_PICTURE_SIZE, color)
+        data = io.BytesIO()
+        image.save(data, "JPEG")
+        return Picture("FAKE_{:04d}.jpg".format(self._count), data.getvalue())
+
+
+def create_camera(backend: str = CAMERA_BACKEND):
+    if backend == "wia":
+        return WiaCamera()
+    if backend == "fake":
+        return FakeCamera()
+    raise ValueError("Unknown camera backend: " + backend)
+
+
+# Long-lived worker owning the camera connection. Commands are queued by the
+# GUI and the outcome of each capture is reported through 'callback', called
+# from the worker thread with the Picture (or None), the error message (or
+# None) and the session given to capture(). The picture is archived on disk
+# once the callback has been called. 'taken', if given, is called from the
+# worker thread with the session as soon as the picture is on the camera,
+# before its transfer: for a burst of pictures, the countdown to the next one
+# runs while the previous one is transferred. The session tells the GUI which
+# photo a picture belongs to, the results of an abandoned photo may still come.
+class CameraService(threading.Thread):
+    CONNECT = "connect"
+    CAPTURE = "capture"
+
+    def __init__(self, camera, callback, taken=None):
+        super().__init__(daemon=True)
+        self._camera = camera
+        self._callback = callback
+        self._taken = taken
+        self._commands = queue.Queue()
+
+    def connect(self):
+        self._commands.put(self.CONNECT)
+
+    def capture(self, session: int = 0):
+        self._commands.put((self.CAPTURE, session))
+
+    def stop(self):
+        self._commands.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                break
+            elif command == self.CONNECT:
+                try:
+                    self._camera.connect()
+                except RuntimeError as e:
+                    # Not fatal, the next capture will try again
+                    print(str(e), file=sys.stderr)
+            elif command[0] == self.CAPTURE:
+                session = command[1]
+                picture, error = self._capture(session)
+                self._callback(picture, error, session)
+                if picture is not None:
+                    self._archive(picture)
+
+    def _capture(self, session: int):
+        try:
+            with metrics.span("camera.trigger"):
+                picture_count = self._camera.take_picture()
+            with metrics.span("camera.wait"):
+                self._camera.wait_for_picture(picture_count)
+            if self._taken is not None:
+                self._taken(session)
+            with metrics.span("camera.transfer"):
+                return self._camera.get_picture(), None
+        except Exception as e:
+            # Drop the handle, the device may have been unplugged
+            self._camera.disconnect()
+            return None, str(e)
+
+    @staticmethod
+    def _archive(picture: Picture):
+        try:
+            picture.archive()
+        except OSError as e:
+            print("Failed to archive picture: " + str(e), file=sys.stderr)
 
 
 if __name__ == "__main__":
     try:
-        camera = find_device(win32com.client.Dispatch("WIA.DeviceManager"))
-        pc = take_picture(camera)
-        wait_for_picture(camera, pc)
-        get_picture(camera)
+        camera = create_camera()
+        pc = camera.take_picture()
+        camera.wait_for_picture(pc)
+        p = camera.get_picture()
+        p.save(CAMERA_OUT_FILENAME)
+        p.archive()
     except RuntimeError as error:
         print(str(error), file=sys.stderr)
         exit(-1)
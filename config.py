@@ -3,9 +3,34 @@
 # Index of the camera in OpenCV, '0' is usually the integrated webcam
 WEBCAM_ID = 1
 
+# Resolution requested to the webcam, close to the preview to avoid resizing
+# each frame (None to keep the default resolution of the webcam)
+WEBCAM_CAPTURE_SIZE = (960, 720)
+
+# Number of buffers for the webcam frames being converted or displayed
+WEBCAM_BUFFER_COUNT = 3
+
+# Webcam backend: "opencv" for the real webcam, "fake" to run without webcam
+WEBCAM_BACKEND = "opencv"
+
+# Frame rate of the fake webcam
+WEBCAM_FAKE_FPS = 30
+
+# Maximum frame rate of the webcam preview
+WEBCAM_TARGET_FPS = 25
+
+# Share of a CPU core the webcam preview may use, its frame rate is reduced
+# when the conversion of each frame takes longer
+WEBCAM_CPU_BUDGET = 0.25
+
 # Duration of the countdown before taking a picture (in seconds)
 COUNTDOWN_DURATION = 7
 
+# Number of pictures taken in a row for each photo, with a short countdown
+# between them (1 for a single picture). They are framed by the frames having
+# as many windows, see FRAME_BURST_WINDOWS.
+BURST_COUNT = 1
+
 # Duration showing the picture taken before coming back to the welcome screen
 INACTIVITY_TIMEOUT = 60000
 
@@ -15,16 +40,70 @@ ERROR_MSG_TIMEOUT = 15000
 # Size of the preview in the GUI
 PREVIEW_SIZE = (960, 720)
 
+# Reduction factor of the draft preview, shown while the full size montage is
+# being made (1 to disable it)
+PREVIEW_DRAFT_SCALE = 2
+
+# Resampling of the preview and of the printed bitmap: "fast" (box filter for
+# the bitmap, nearest pixel for the preview), "balanced" (bilinear) or "best"
+# (Lanczos for the bitmap, pixel area for the preview)
+RESAMPLING_PRESET = "balanced"
+
 
 # --- Printer Config ---
-# Identification of the printer
-PRINTER_NAME = "Canon SELPHY CP1500"
+# Printer backend: "win32" for the real printer, "file" to copy the pictures to
+# PRINTER_FILE_DIRECTORY instead
+PRINTER_BACKEND = "win32"
+
+# Identification of the printers, each picture is sent to the one expected to
+# print it first
+PRINTER_NAMES = ["Canon SELPHY CP1500"]
 
 # Directory to store all the pictures printed
 PRINTER_OUT_DIRECTORY = "printed"
 
+# Number of copies printed for each picture
+PRINTER_COPIES = 1
+
+# Duration of a print, to compute when the next one can start (in seconds)
+PRINTER_PRINT_DURATION = 45
+
+# Duration of a print for some of the printers, by name, when it differs from
+# PRINTER_PRINT_DURATION (in seconds)
+PRINTER_PRINT_DURATIONS = {}
+
+# Interval between two checks of the printer status (in seconds)
+PRINTER_STATUS_INTERVAL = 10
+
+# Directory receiving the pictures "printed" by the file backend, in a
+# sub-directory for each printer
+PRINTER_FILE_DIRECTORY = "spool"
+
+# Time taken by the file backend to "print" a picture (in seconds)
+PRINTER_FILE_DELAY = 1.0
+
+# Share of the prints failing with the file backend, from 0 to 1
+PRINTER_FILE_FAILURE_RATE = 0.0
+
+# Share of the prints turning off a printer of the file backend, from 0 to 1,
+# and for how long (in seconds)
+PRINTER_FILE_OUTAGE_RATE = 0.0
+PRINTER_FILE_OUTAGE_DURATION = 60
+
 
 # --- Camera Config ---
+# Camera backend: "wia" for the real camera, "fake" to run without camera
+CAMERA_BACKEND = "wia"
+
+# Delay of the fake camera between the trigger and the picture (in seconds)
+CAMERA_FAKE_DELAY = 1.0
+
+# Time taken by the fake camera to transfer a picture (in seconds)
+CAMERA_FAKE_TRANSFER_DELAY = 0.3
+
+# Share of the pictures failing with the fake camera, from 0 to 1
+CAMERA_FAKE_FAILURE_RATE = 0.0
+
 # Identification of the camera
 CAMERA_MANUFACTURER = "Nikon Corporation"
 CAMERA_DEVICE_NAME = "D70s"
@@ -32,7 +111,7 @@ CAMERA_DEVICE_NAME = "D70s"
 # Directory to store all the original pictures taken by the camera
 CAMERA_OUT_DIRNAME = "pictures"
 
-# Filename of the latest picture taken by the camera
+# Filename of the latest picture, when camera.py is run as a standalone script
 CAMERA_OUT_FILENAME = "latest.jpg"
 
 # Size of the pictures taken by the camera
@@ -41,6 +120,15 @@ CAMERA_PICTURE_SIZE = (1504, 1000)
 # Number of attempts to take a picture before showing an error
 CAMERA_MAX_RETRY = 3
 
+# Use the WIA events to detect the new picture (the item count is polled too)
+CAMERA_ARRIVAL_EVENTS = True
+
+# Maximum duration to wait for the new picture on the camera (in seconds)
+CAMERA_ARRIVAL_TIMEOUT = 15
+
+# Min and max interval between two checks for the new picture (in seconds)
+CAMERA_POLL_INTERVAL = (0.05, 0.5)
+
 
 # --- Photo montage config ---
 # Directory for the empty frames
@@ -52,5 +140,68 @@ FRAMED_PICTURE_SIZE = (1748, 1181)
 # Position of the image within the frame
 FRAME_IMAGE_POS = (122, 91)
 
-# Filename of the framed picture
+# Windows of the frames for several pictures (see BURST_COUNT), by number of
+# pictures: position and size of each window, in the order the pictures are
+# taken. The pictures are scaled and cropped to fill their window.
+FRAME_BURST_WINDOWS = {
+    4: [(60, 60, 794, 510), (894, 60, 794, 510),
+        (60, 610, 794, 510), (894, 610, 794, 510)],
+}
+
+# Memory for the frames kept decoded, ready for the montage (in MB)
+FRAME_CACHE_SIZE = 256
+
+# Number of frames rendered in advance for the preview, 0 for all of them
+PRERENDER_COUNT = 5
+
+# Number of threads rendering the previews in advance
+PRERENDER_WORKERS = 2
+
+# Filename of the framed picture, its extension sets the file format: PNG or
+# BMP (JPEG cannot store the transparent montage)
 FRAME_OUT_FILENAME = "latest-framed.png"
+
+# PNG compression of the framed picture, from 0 (fastest) to 9 (smallest)
+FRAME_OUT_COMPRESS_LEVEL = 1
+
+# Delay showing a preview before its framed picture is saved (in ms), it is
+# saved right away when the print button is pressed
+FRAME_OUT_SAVE_DELAY = 2000
+
+
+# --- Gallery config ---
+# Directory of the gallery of the photos taken, for the reprints (thumbnails,
+# their index and the latest print-ready bitmaps). 'python gallery.py' adds the
+# pictures of PRINTER_OUT_DIRECTORY missing from it.
+GALLERY_DIRECTORY = "gallery"
+
+# Size of the thumbnails of the gallery (in pixels)
+GALLERY_THUMBNAIL_SIZE = (222, 150)
+
+# Number of the latest photos keeping their bitmap ready for the printer (about
+# 6 MB each), the older ones are prepared again to be reprinted
+GALLERY_PRINT_CACHE = 50
+
+
+# --- Archive config ---
+# Maximum number of files waiting to be archived, taking a picture or printing
+# waits beyond that
+ARCHIVE_QUEUE_SIZE = 16
+
+# Maximum number of archived files synced to the disk together
+ARCHIVE_SYNC_BATCH = 8
+
+
+# --- Metrics config ---
+# Log of the duration of each stage of the booth, in the directory of the booth
+# (None to disable it), see the summary with 'python metrics.py'
+METRICS_FILENAME = "metrics.jsonl"
+
+# Size of the log before it is rotated (in MB)
+METRICS_FILE_SIZE = 1
+
+# Number of rotated logs kept
+METRICS_FILE_COUNT = 5
+
+# Number of the latest durations kept in memory
+METRICS_BUFFER_SIZE = 1000
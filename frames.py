@@ -0,0 +1,225 @@
+import os
+import threading
+from collections import OrderedDict
+from os.path import join, splitext
+import numpy as np
+from PIL import Image
+from config import (FRAME_DIRECTORY, FRAME_CACHE_SIZE, FRAMED_PICTURE_SIZE,
+                    FRAME_IMAGE_POS, FRAME_BURST_WINDOWS, CAMERA_PICTURE_SIZE,
+                    PREVIEW_SIZE, PREVIEW_DRAFT_SCALE)
+from montage import FrameLayer, premultiply, scaled, scaled_window
+
+# Reduction of the frames for the previews, so that a montage is as high as
+# the preview: the previews never need the pictures at full size
+PREVIEW_SCALE = max(1.0, FRAMED_PICTURE_SIZE[1] / PREVIEW_SIZE[1])
+
+
+def bounding_box(mask: np.ndarray):
+    # (left, top, right, bottom) of the True values, None if there are none
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero(mask.any(axis=0))
+    return (int(columns[0]), int(rows[0]), int(columns[-1]) + 1,
+            int(rows[-1]) + 1)
+
+
+def frame_layouts() -> list:
+    # Picture windows of the frames accepted, (x, y, width, height) of each
+    # window: the single picture one, then those for several pictures
+    return [[FRAME_IMAGE_POS + CAMERA_PICTURE_SIZE]] + [
+        [tuple(window) for window in windows]
+        for _, windows in sorted(FRAME_BURST_WINDOWS.items())]
+
+
+def layout(count: int) -> list:
+    # Windows of the frames for 'count' pictures, None if there are none
+    for windows in frame_layouts():
+        if len(windows) == count:
+            return windows
+    return None
+
+
+def find_windows(alpha: np.ndarray):
+    # Windows of the layout matching the transparent area of a frame: each
+    # window transparent up to its edges. When several layouts match, the one
+    # leaving the fewest transparent pixels outside of its windows (the
+    # decorative cut-outs of the frame). None when no layout matches.
+    transparent = alpha == 0
+    total = np.count_nonzero(transparent)
+    best, best_outside = None, None
+    for windows in frame_layouts():
+        inside = 0
+        for x, y, w, h in windows:
+            area = transparent[y:y + h, x:x + w]
+            if area.shape != (h, w) or bounding_box(area) != (0, 0, w, h):
+                break
+            inside += np.count_nonzero(area)
+        else:
+            if best is None or total - inside < best_outside:
+                best, best_outside = windows, total - inside
+    return best
+
+
+class Frame:
+    def __init__(self, path: str, mtime: int, rgba: np.ndarray,
+                 scale: float = 1, windows: list = None):
+        self.path = path
+        self.mtime = mtime
+        self.rgba = rgba
+        self.alpha = rgba[..., 3]
+        self.size = (rgba.shape[1], rgba.shape[0])
+        self.scale = scale
+        # The reduction blends the edges of the windows with the frame, the
+        # pictures must show through them without lowering the alpha
+        self._opaque_alpha = scale != 1
+        # Windows at full scale, the single picture one when none matches
+        if windows is None:
+            windows = (find_windows(self.alpha) or
+                       [FRAME_IMAGE_POS + CAMERA_PICTURE_SIZE])
+        # Windows of the pictures at the scale of this frame, in the order of
+        # the pictures, with the pixels they partly cover
+        self.windows = [scaled_window(window, scale) for window in windows]
+        # Canvas outside of the windows, shared by their layers
+        self.base = premultiply(rgba)
+        self._layers = {}
+        # Prepared for the expected pictures, other sizes are done on demand
+        for x, y, w, h in self.windows:
+            self.layer((x, y), (h, w))
+        self.nbytes = self.rgba.nbytes + self.base.nbytes + sum(
+            layer.nbytes for layer in self._layers.values())
+        # Reduced copies of the frame, for the previews and the draft previews
+        # (the frame itself when no reduction is needed)
+        self.preview = self.draft = None
+        if scale == 1:
+            self.preview = self._reduced(PREVIEW_SCALE, windows)
+            if PREVIEW_DRAFT_SCALE > 1:
+                self.draft = self._reduced(PREVIEW_DRAFT_SCALE, windows)
+
+    def _reduced(self, scale: float, windows: list):
+        if scale == 1:
+            return self
+        image = Image.fromarray(self.rgba, "RGBA").resize(
+            scaled(self.size, scale), Image.BOX)
+        frame = Frame(self.path, self.mtime, np.asarray(image), scale,
+                      windows)
+        self.nbytes += frame.nbytes
+        return frame
+
+    def layer(self, pos: tuple, picture_shape: tuple) -> FrameLayer:
+        key = (pos, picture_shape[:2])
+        layer = self._layers.get(key)
+        if layer is None:
+            layer = self._layers[key] = FrameLayer(
+                self.rgba, pos, picture_shape, self.base, self._opaque_alpha)
+        return layer
+
+
+class FrameInfo:
+    def __init__(self, path: str, mtime: int, windows: list):
+        self.path = path
+        self.mtime = mtime
+        # Windows of the pictures, one for each picture framed
+        self.windows = windows
+
+
+def load_frame(info: FrameInfo) -> Frame:
+    # With the windows found by check_frame()
+    with Image.open(info.path) as image:
+        return Frame(info.path, info.mtime,
+                     np.asarray(image.convert("RGBA")), windows=info.windows)
+
+
+# Decoded frames, ready for compositing. The least recently used frames are
+# evicted when the total size exceeds the limit, and a frame is decoded again
+# when the catalogue finds its file modified.
+class FrameCache:
+    def __init__(self, max_size: int = FRAME_CACHE_SIZE * 1024 * 1024):
+        self._max_size = max_size
+        self._size = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, info: FrameInfo) -> Frame:
+        path = info.path
+        with self._lock:
+            frame = self._frames.get(path)
+            if frame is not None and frame.mtime == info.mtime:
+                self._frames.move_to_end(path)
+                return frame
+        frame = load_frame(info)
+        with self._lock:
+            self._remove(path)
+            self._frames[path] = frame
+            self._size += frame.nbytes
+            # Always keep the frame just loaded
+            while self._size > self._max_size and len(self._frames) > 1:
+                self._remove(next(iter(self._frames)))
+        return frame
+
+    def _remove(self, path: str):
+        frame = self._frames.pop(path, None)
+        if frame is not None:
+            self._size -= frame.nbytes
+
+
+def check_frame(path: str, mtime: int) -> FrameInfo:
+    # Raises ValueError when the picture cannot be framed as expected
+    with Image.open(path) as image:
+        if image.size != FRAMED_PICTURE_SIZE:
+            raise ValueError("unexpected resolution {}x{}".format(*image.size))
+        if "A" not in image.getbands() and "transparency" not in image.info:
+            raise ValueError("no transparency")
+        alpha = np.asarray(image.convert("RGBA").getchannel("A"))
+
+    # The picture windows must be fully transparent, up to their edges
+    windows = find_windows(alpha)
+    if windows is None:
+        raise ValueError("transparent area {} does not match the picture "
+                         "windows".format(bounding_box(alpha == 0)))
+    # The pictures do not show through the cut-outs outside of the windows
+    visible = alpha < 255
+    for x, y, w, h in windows:
+        visible[y:y + h, x:x + w] = False
+    if visible.any():
+        print("Warning: frame " + path + " is not opaque outside of the "
+              "picture windows")
+    return FrameInfo(path, mtime, windows)
+
+
+# Frames available in a directory, checked when they are found. Each refresh()
+# lists the directory again, but only opens the new or modified frames: it is
+# cheap enough to be done for each picture, so frames can be added at any time.
+class FrameCatalogue:
+    def __init__(self, directory: str = FRAME_DIRECTORY):
+        self._directory = directory
+        self._frames = {}
+        # Modification time of the frames rejected, reported only once
+        self._rejected = {}
+        self.frames = []
+
+    def refresh(self) -> list:
+        found = set()
+        for entry in os.scandir(self._directory):
+            if (not entry.is_file() or
+                    splitext(entry.name)[1].lower() != ".png"):
+                continue
+            path = join(self._directory, entry.name)
+            mtime = entry.stat().st_mtime_ns
+            found.add(path)
+            info = self._frames.get(path)
+            if info is not None and info.mtime == mtime:
+                continue
+            if self._rejected.get(path) == mtime:
+                continue
+            try:
+                self._frames[path] = check_frame(path, mtime)
+                self._rejected.pop(path, None)
+            except (OSError, ValueError) as e:
+                self._frames.pop(path, None)
+                self._rejected[path] = mtime
+                print("Frame " + path + " ignored: " + str(e))
+        for path in set(self._frames) - found:
+            del self._frames[path]
+        self.frames = [self._frames[path] for path in sorted(self._frames)]
+        return self.frames
@@ -0,0 +1,198 @@
+import io
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists, splitext
+import numpy as np
+from PIL import Image
+import archive
+from montage import fit_picture
+from metrics import metrics
+from config import (GALLERY_DIRECTORY, GALLERY_THUMBNAIL_SIZE,
+                    GALLERY_PRINT_CACHE, PRINTER_OUT_DIRECTORY)
+
+# Files of the gallery directory: thumbnails packed one after the other, index
+# of the photos, and the print-ready bitmaps of the latest ones
+PACK_FILENAME = "thumbnails.pack"
+INDEX_FILENAME = "gallery.db"
+PRINT_DIRNAME = "print"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    slot INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    time REAL NOT NULL,
+    print_file TEXT
+)
+"""
+
+
+def make_thumbnail(montage: np.ndarray,
+                   size: tuple = GALLERY_THUMBNAIL_SIZE) -> np.ndarray:
+    # RGB, from the RGB or RGBA montage
+    thumbnail = fit_picture(montage, size, "best")
+    return np.ascontiguousarray(thumbnail[..., :3])
+
+
+class GalleryEntry:
+    def __init__(self, slot: int, name: str, time: float, print_file: str):
+        # Position of the thumbnail in the pack, in the order of the photos
+        self.slot = slot
+        # Picture in PRINTER_OUT_DIRECTORY
+        self.name = name
+        self.time = time
+        # Bitmap ready for the printer, None once evicted
+        self.print_file = print_file
+
+    @property
+    def path(self) -> str:
+        # File to reprint, the printed picture has to be prepared again
+        if self.print_file is not None and exists(self.print_file):
+            return self.print_file
+        return join(PRINTER_OUT_DIRECTORY, self.name)
+
+
+# Photos of the booth, for the reprints. The thumbnails have a fixed size and
+# are packed in a single file, the thumbnail of a photo being at the offset of
+# its slot: they are read through a memory map, without decoding nor copying,
+# so that paging through thousands of them costs only what is displayed. A
+# small SQLite index gives the photo of each slot. Photos are added in the
+# background, the thumbnail being written before its row: the pack may hold
+# a thumbnail not indexed yet, never the other way round. The print-ready
+# bitmaps of the latest photos are kept, the older ones are prepared again
+# from the printed pictures.
+class Gallery:
+    def __init__(self, directory: str = GALLERY_DIRECTORY,
+                 size: tuple = GALLERY_THUMBNAIL_SIZE,
+                 print_cache: int = GALLERY_PRINT_CACHE):
+        self._size = size
+        self._print_cache = print_cache
+        self._slot_size = size[0] * size[1] * 3
+        self._pack_path = join(directory, PACK_FILENAME)
+        self._print_directory = join(directory, PRINT_DIRNAME)
+        os.makedirs(self._print_directory, exist_ok=True)
+        # Used by the GUI thread and the writer, one at a time
+        self._db = sqlite3.connect(join(directory, INDEX_FILENAME),
+                                   check_same_thread=False)
+        self._db.execute(SCHEMA)
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(1)
+        self._count = self._db.execute(
+            "SELECT COALESCE(MAX(slot) + 1, 0) FROM photos").fetchone()[0]
+        self._map = None
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def add(self, name: str, thumbnail: np.ndarray,
+            print_image: Image.Image = None):
+        # Returns the Future of the slot given to the photo (None if it could
+        # not be added)
+        return self._writer.submit(self._add, name, thumbnail, print_image)
+
+    def entry(self, slot: int) -> GalleryEntry:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT slot, name, time, print_file FROM photos "
+                "WHERE slot = ?", (slot,)).fetchone()
+        return GalleryEntry(*row) if row is not None else None
+
+    def names(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._db.execute(
+                "SELECT name FROM photos")}
+
+    def thumbnail(self, slot: int) -> np.ndarray:
+        # View of the pack (height x width x RGB), None if missing
+        if slot >= self._count:
+            return None
+        if self._map is None or slot >= len(self._map):
+            # The pack has grown, mapped again
+            count = min(self._count,
+                        os.path.getsize(self._pack_path) // self._slot_size)
+            if count == 0 or slot >= count:
+                return None
+            self._map = np.memmap(self._pack_path, np.uint8, "r", shape=(
+                count, self._size[1], self._size[0], 3))
+        return self._map[slot]
+
+    def close(self):
+        self._writer.shutdown()
+        self._map = None
+        self._db.close()
+
+    def _add(self, name: str, thumbnail: np.ndarray,
+             print_image: Image.Image) -> int:
+        try:
+            with metrics.span("gallery.add"):
+                return self._write(name, thumbnail, print_image)
+        except (OSError, sqlite3.Error) as e:
+            print("Failed to add " + name + " to the gallery: " + str(e),
+                  file=sys.stderr)
+            return None
+
+    def _write(self, name: str, thumbnail: np.ndarray,
+               print_image: Image.Image) -> int:
+        slot = self._count
+        if thumbnail.shape != (self._size[1], self._size[0], 3):
+            thumbnail = make_thumbnail(thumbnail, self._size)
+        mode = "r+b" if exists(self._pack_path) else "wb"
+        with open(self._pack_path, mode) as f:
+            f.seek(slot * self._slot_size)
+            f.write(thumbnail.tobytes())
+        print_file = None
+        if print_image is not None:
+            print_file = join(self._print_directory,
+                              splitext(name)[0] + ".bmp")
+            data = io.BytesIO()
+            print_image.save(data, "BMP")
+            archive.writer.write(print_file, data.getvalue())
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO photos VALUES (?, ?, ?, ?)",
+                             (slot, name, time.time(), print_file))
+            evicted = self._db.execute(
+                "SELECT slot, print_file FROM photos WHERE slot <= ? "
+                "AND print_file IS NOT NULL",
+                (slot - self._print_cache,)).fetchall()
+            self._db.executemany(
+                "UPDATE photos SET print_file = NULL WHERE slot = ?",
+                [(evicted_slot,) for evicted_slot, _ in evicted])
+        self._count = slot + 1
+        for _, path in evicted:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print("Failed to remove " + path + ": " + str(e),
+                      file=sys.stderr)
+        return slot
+
+
+if __name__ == "__main__":
+    # Adds the printed pictures missing from the gallery, e.g. those printed
+    # before it existed
+    gallery = Gallery()
+    known = gallery.names()
+    printed = []
+    for filename in os.listdir(PRINTER_OUT_DIRECTORY):
+        match = archive.INDEX_PATTERN.match(filename)
+        if (match and filename not in known and
+                not filename.endswith(".tmp")):
+            printed.append((int(match.group(1)), filename))
+    added = 0
+    for _, filename in sorted(printed):
+        try:
+            with Image.open(join(PRINTER_OUT_DIRECTORY, filename)) as image:
+                image.draft("RGB", (GALLERY_THUMBNAIL_SIZE[0] * 2,
+                                    GALLERY_THUMBNAIL_SIZE[1] * 2))
+                thumbnail = make_thumbnail(np.asarray(image.convert("RGB")))
+        except OSError as e:
+            print("Skipped " + filename + ": " + str(e), file=sys.stderr)
+            continue
+        gallery.add(filename, thumbnail)
+        added += 1
+    gallery.close()
+    print("{} pictures added, {} in the gallery".format(added, gallery.count))
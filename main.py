@@ -1,18 +1,26 @@
 import sys
 import os
-import cv2
-from PyQt5.QtWidgets import (QMainWindow, QApplication, QWidget, QHBoxLayout,
-                             QPushButton, QVBoxLayout, QFrame,
-                             QGraphicsDropShadowEffect, QLabel, QGridLayout)
-from PyQt5.QtCore import Qt, pyqtSignal, QSize, QTimer, QProcess, QThread
-from PyQt5.QtGui import QImage, QPixmap, QIcon
-from os.path import join, dirname, splitext
-from random import randrange
-from PIL import Image
-from config import (WEBCAM_ID, COUNTDOWN_DURATION, INACTIVITY_TIMEOUT,
-                    ERROR_MSG_TIMEOUT, CAMERA_MAX_RETRY, CAMERA_PICTURE_SIZE,
-                    CAMERA_OUT_FILENAME, PREVIEW_SIZE, FRAME_DIRECTORY,
-                    FRAMED_PICTURE_SIZE, FRAME_IMAGE_POS, FRAME_OUT_FILENAME)
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from startup import profile, warm_up
+from PyQt5.QtWidgets import (QMainWindow, QApplication, QHBoxLayout,
+                             QPushButton, QVBoxLayout, QFrame, QLabel,
+                             QGridLayout, QAbstractScrollArea, QScroller)
+from PyQt5.QtCore import Qt, pyqtSignal, QSize, QTimer
+from PyQt5.QtGui import QImage, QPainter, QPen, QPixmap, QIcon
+from os.path import join, dirname
+from metrics import metrics
+from widgets import CentralWidget, apply_font, apply_shadow
+from config import (WEBCAM_ID, WEBCAM_TARGET_FPS, COUNTDOWN_DURATION,
+                    BURST_COUNT, INACTIVITY_TIMEOUT, ERROR_MSG_TIMEOUT,
+                    CAMERA_MAX_RETRY, PREVIEW_SIZE, FRAME_DIRECTORY,
+                    FRAME_OUT_FILENAME, GALLERY_THUMBNAIL_SIZE,
+                    PRINTER_COPIES)
+
+# Only PyQt is imported up front: the modules using OpenCV, NumPy and PIL are
+# imported by the warm-up, while the welcome screen is shown
+profile.record("imports")
 
 # How to disable edge-of-touchscreen gestures:
 # https://sps-support.honeywell.com/s/article/How-to-disable-touchscreen-edge-swipes-in-Windows-10
@@ -21,74 +29,87 @@ from config import (WEBCAM_ID, COUNTDOWN_DURATION, INACTIVITY_TIMEOUT,
 # Create new 32-bit DWORD entry with value 0
 
 
-def apply_shadow(widget: QWidget, radius: float):
-    shadow = QGraphicsDropShadowEffect()
-    shadow.setBlurRadius(radius)
-    shadow.setColor(Qt.black)
-    shadow.setOffset(0, 0)
-    widget.setGraphicsEffect(shadow)
-
-
-def apply_font(widget: QWidget, size: int, bold: bool = False,
-               italic: bool = False):
-    f = widget.font()
-    f.setFamily("Century Gothic")
-    f.setBold(bold)
-    f.setItalic(italic)
-    f.setPixelSize(size)
-    widget.setFont(f)
-
-
-class CentralWidget(QFrame):
+class ImageLabel(QLabel):
+    # Paints an image without converting it to a pixmap first
     def __init__(self, parent):
         super().__init__(parent)
-        self.setObjectName("CentralWidget")
-        self._size = QSize(*PREVIEW_SIZE)
-        apply_shadow(self, 100)
-        self._img = QLabel(self)
-        self._img.setAlignment(Qt.AlignCenter)
-        self._img.setFixedSize(self._size)
-        grid = QVBoxLayout()
-        grid.setContentsMargins(5, 5, 5, 5)
-        grid.addWidget(self._img)
-        self.setLayout(grid)
+        self._image = None
+
+    def set_image(self, image: QImage):
+        self._image = image
+        self.update()
+
+    def paintEvent(self, event):
+        if self._image is None:
+            super().paintEvent(event)
+        else:
+            painter = QPainter(self)
+            painter.drawImage(self.rect(), self._image)
 
 
 class WebcamWidget(CentralWidget):
     def __init__(self, parent):
-        super().__init__(parent)
+        super().__init__(parent, ImageLabel)
+        self._capture = None
+        self._images = []
         self._frame_timer = QTimer(self)
         self._frame_timer.setSingleShot(False)
-        self._frame_timer.setInterval(20)
+        self._frame_timer.setInterval(1000 // WEBCAM_TARGET_FPS // 2)
         self._frame_timer.timeout.connect(self._frame_update)
-        QTimer.singleShot(0, self._init_webcam)
-
-    def _init_webcam(self):
         self._img.setText("Connection à la webcam...")
-        self.repaint()
-        self._capture = cv2.VideoCapture(WEBCAM_ID)
-        if self._capture.isOpened():
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self._capture is not None and self._capture.is_alive():
+            self._capture.resume()
+            self._frame_timer.start()
+
+    def hideEvent(self, event):
+        # No need to read the webcam while it is not displayed, the webcam
+        # stays open to resume without delay
+        super().hideEvent(event)
+        if self._capture is not None and self._capture.is_alive():
+            self._capture.pause()
+            self._frame_timer.stop()
+
+    def open(self) -> bool:
+        # Called from a background thread, the webcam can take a few seconds
+        # to open. Imported here, OpenCV is slow to load.
+        from webcam import WebcamCapture
+        self._capture = WebcamCapture(
+            WEBCAM_ID, (self._size.width(), self._size.height()))
+        return self._capture.open()
+
+    def start(self, opened: bool):
+        if opened:
+            # One image per buffer of the capture thread, created only once
+            self._images = [QImage(buffer, buffer.shape[1], buffer.shape[0],
+                                   buffer.shape[1] * 3, QImage.Format_BGR888)
+                            for buffer in self._capture.buffers]
             self._img.setText("")
+            self._capture.start()
             self._frame_timer.start()
         else:
             self._img.setText("Echec de connection à la webcam")
 
+    def record_stats(self):
+        if self._capture is not None and self._capture.is_alive():
+            self._capture.record_stats()
+
+    def stop(self):
+        self._frame_timer.stop()
+        if self._capture is not None and self._capture.is_alive():
+            self._capture.record_stats()
+            self._capture.stop()
+
     def _frame_update(self):
-        is_reading, frame = self._capture.read()
-        if is_reading:
-            image = self._convert_image(frame)
-            self._img.setPixmap(QPixmap.fromImage(image))
-        else:
+        # Frames are read and converted by the capture thread
+        if not self._capture.is_alive():
             self._frame_timer.stop()
-
-    def _convert_image(self, image):
-        image = cv2.resize(image, (self._size.width(), self._size.height()),
-                           interpolation=cv2.INTER_AREA)
-        image = cv2.flip(image, 1)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = QImage(image, image.shape[1], image.shape[0],
-                       QImage.Format_RGB888)
-        return image
+            return
+        index = self._capture.acquire()
+        if index is not None:
+            self._img.set_image(self._images[index])
 
 
 class Cheese(CentralWidget):
@@ -100,19 +121,36 @@ class Cheese(CentralWidget):
         self._err_icon = QIcon(join("assets", "error.svg"))
         apply_font(self._img, 500)
         apply_shadow(self._img, 50)
+        self._seconds = 0
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(1000)
+        self._timer.timeout.connect(self._one_second)
+
+    @property
+    def counting(self) -> bool:
+        return self._timer.isActive()
 
     def start(self):
         self._img.setPixmap(QPixmap())
-        self._img.setText("2")
-        QTimer.singleShot(1000, self._one_second)
+        self._seconds = 2
+        self._img.setText(str(self._seconds))
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
 
     def error(self):
         self._img.setText("")
         self._img.setPixmap(self._err_icon.pixmap(self._img.size()))
 
     def _one_second(self):
-        self._img.setText("1")
-        QTimer.singleShot(1000, self._cheese)
+        self._seconds -= 1
+        if self._seconds > 0:
+            self._img.setText(str(self._seconds))
+            self._timer.start()
+        else:
+            self._cheese()
 
     def _cheese(self):
         self._img.setText("")
@@ -120,60 +158,125 @@ class Cheese(CentralWidget):
         self.take_picture.emit()
 
 
-class Preview(CentralWidget):
-    preview_ready = pyqtSignal()
+class GalleryView(QAbstractScrollArea):
+    selected = pyqtSignal(int)
 
-    def __init__(self, parent):
+    # Space around each thumbnail (in pixels)
+    MARGIN = 9
+
+    # Thumbnails of the gallery, the newest first. Only the visible ones are
+    # painted, straight from the memory map of the gallery: scrolling through
+    # thousands of photos costs the same as through a few. The view scrolls
+    # with the finger, with inertia, and a tap selects a photo.
+    def __init__(self, parent, gallery):
         super().__init__(parent)
-        self._bg_thread = QThread(self)
-        self._bg_thread.run = self._make_montage
-        self._bg_thread.finished.connect(self._on_montage_done)
-        self._icon = QIcon(join("assets", "wait.svg"))
-        self._pixmap = QPixmap()
-        self._current_frame = 0
-        self._frames = []
-
-    def _new_frame(self):
-        self._frames = [join(FRAME_DIRECTORY, f)
-                        for f in next(os.walk(FRAME_DIRECTORY))[2]
-                        if splitext(f)[1].lower() == ".png"]
-        self._current_frame = randrange(len(self._frames))
-
-    def _next_frame(self):
-        self._current_frame += 1
-        if self._current_frame >= len(self._frames):
-            self._current_frame = 0
-
-    def compute(self, randomized):
-        if randomized:
-            self._new_frame()
-        else:
-            self._next_frame()
-        self._img.setPixmap(self._icon.pixmap(self._img.size() / 2))
-        self._bg_thread.start()
-
-    def _make_montage(self):
-        frame = Image.open(self._frames[self._current_frame])
-        picture = Image.open(CAMERA_OUT_FILENAME)
-        if frame.size != FRAMED_PICTURE_SIZE:
-            print("Warning: frame has unexpected resolution")
-        if picture.size != CAMERA_PICTURE_SIZE:
-            print("Warning: picture from camera has unexpected resolution")
-        output = Image.new('RGBA', frame.size)
-        output.paste(picture, FRAME_IMAGE_POS)
-        output.paste(frame, (0, 0), frame)
-        output.save(FRAME_OUT_FILENAME)
-        pixmap = QPixmap(FRAME_OUT_FILENAME)
-        cropped_w = round(pixmap.height() *
-                          self._size.width() / self._size.height())
-        pixmap = pixmap.copy((pixmap.width() - cropped_w) // 2, 0,
-                             cropped_w, pixmap.height())
-        self._pixmap = pixmap.scaled(
-            self._size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-
-    def _on_montage_done(self):
-        self._img.setPixmap(self._pixmap)
-        self.preview_ready.emit()
+        self._gallery = gallery
+        self._count = 0
+        self._selected = None
+        w, h = GALLERY_THUMBNAIL_SIZE
+        self._cell = QSize(w + 2 * self.MARGIN, h + 2 * self.MARGIN)
+        self.setFrameShape(QFrame.NoFrame)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        QScroller.grabGesture(self.viewport(),
+                              QScroller.LeftMouseButtonGesture)
+        apply_font(self, 40)
+
+    @property
+    def selected_slot(self) -> int:
+        return self._selected
+
+    def refresh(self):
+        # Photos added since the last time, back to the newest one
+        self._count = self._gallery.count
+        self._selected = None
+        self._update_range()
+        self.verticalScrollBar().setValue(0)
+        self.viewport().update()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._update_range()
+
+    def _columns(self) -> int:
+        return max(1, self.viewport().width() // self._cell.width())
+
+    def _update_range(self):
+        height = self.viewport().height()
+        rows = math.ceil(self._count / self._columns())
+        bar = self.verticalScrollBar()
+        bar.setRange(0, max(0, rows * self._cell.height() - height))
+        bar.setPageStep(height)
+        bar.setSingleStep(self._cell.height())
+
+    def _left(self) -> int:
+        # Columns centered in the view
+        return (self.viewport().width() -
+                self._columns() * self._cell.width()) // 2
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        if self._count == 0:
+            painter.setPen(Qt.white)
+            painter.drawText(self.viewport().rect(), Qt.AlignCenter,
+                             "Aucune photo pour l'instant")
+            return
+        columns = self._columns()
+        cell_w, cell_h = self._cell.width(), self._cell.height()
+        w, h = GALLERY_THUMBNAIL_SIZE
+        top = self.verticalScrollBar().value()
+        first_row = top // cell_h
+        last_row = (top + self.viewport().height()) // cell_h
+        for position in range(first_row * columns,
+                              min(self._count, (last_row + 1) * columns)):
+            slot = self._count - 1 - position
+            thumbnail = self._gallery.thumbnail(slot)
+            if thumbnail is None:
+                continue
+            x = self._left() + position % columns * cell_w + self.MARGIN
+            y = position // columns * cell_h - top + self.MARGIN
+            painter.drawImage(x, y, QImage(thumbnail, w, h, w * 3,
+                                           QImage.Format_RGB888))
+            if slot == self._selected:
+                painter.setPen(QPen(Qt.white, self.MARGIN - 1))
+                painter.drawRect(x - self.MARGIN // 2, y - self.MARGIN // 2,
+                                 w + self.MARGIN - 1, h + self.MARGIN - 1)
+
+    def mouseReleaseEvent(self, event):
+        # Only the taps reach here, the drags are handled by the scroller
+        super().mouseReleaseEvent(event)
+        column = (event.x() - self._left()) // self._cell.width()
+        row = ((event.y() + self.verticalScrollBar().value()) //
+               self._cell.height())
+        position = row * self._columns() + column
+        if not 0 <= column < self._columns() or position >= self._count:
+            return
+        self._selected = self._count - 1 - position
+        self.viewport().update()
+        self.selected.emit(self._selected)
+
+
+class GalleryWidget(QFrame):
+    selected = pyqtSignal(int)
+
+    def __init__(self, parent, gallery):
+        super().__init__(parent)
+        self.setObjectName("CentralWidget")
+        apply_shadow(self, 100)
+        self._view = GalleryView(self, gallery)
+        self._view.setFixedSize(QSize(*PREVIEW_SIZE))
+        self._view.selected.connect(self.selected)
+        grid = QVBoxLayout()
+        grid.setContentsMargins(5, 5, 5, 5)
+        grid.addWidget(self._view)
+        self.setLayout(grid)
+
+    @property
+    def selected_slot(self) -> int:
+        return self._view.selected_slot
+
+    def refresh(self):
+        self._view.refresh()
 
 
 class AbstractButton(QFrame):
@@ -216,6 +319,13 @@ class PrinterWidget(AbstractButton):
         self._label.setText("Imprimer la photo")
 
 
+class GalleryButtonWidget(AbstractButton):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self._button.setIcon(QIcon(join("assets", "gallery.svg")))
+        self._label.setText("Réimprimer une photo")
+
+
 class ChangeQuoteWidget(AbstractButton):
     def __init__(self, parent):
         super().__init__(parent)
@@ -251,22 +361,42 @@ class BottomLabel(QFrame):
         self._title.setText("Regardez l'objectif")
         self._subtitle.setText("")
 
+    def set_next_shot(self, number: int, count: int):
+        self._title.setText("Photo {} sur {}".format(number, count))
+        self._subtitle.setText("Changez de pose !")
+
     def set_review_picture(self):
         self._title.setText("Magnifique ! On imprime ?")
         self._subtitle.setText("")
 
+    def set_gallery(self):
+        self._title.setText("Quelle photo réimprimer ?")
+        self._subtitle.setText("Touchez la photo, puis le bouton d'impression")
+
     def set_pre_printing(self):
         self._title.setText("Démarrage de l'impression...")
         self._subtitle.setText("")
 
-    def set_printing(self):
-        self._title.setText("Impression en cours")
-        self._subtitle.setText("La photo sera prête dans 45 secondes")
+    def set_printing(self, position: int, eta: float):
+        eta = "{} secondes".format(math.ceil(eta))
+        if position == 0:
+            self._title.setText("Impression en cours")
+            self._subtitle.setText("La photo sera prête dans " + eta)
+        else:
+            self._title.setText("Impression en attente")
+            self._subtitle.setText(
+                "{} photo(s) avant la vôtre, prête dans {}".format(
+                    position, eta))
 
     def set_photo_error(self):
         self._title.setText("Echec de prise de vue")
         self._subtitle.setText("Si le problème persiste, appelez Sylvain")
 
+    def set_startup_error(self):
+        self._title.setText("Echec du démarrage")
+        self._subtitle.setText("Relancez le stand, si le problème persiste, "
+                               "appelez Sylvain")
+
     def set_printer_error(self):
         self._title.setText("Echec d'impression")
         self._subtitle.setText("La photo est quand même sauvegardée")
@@ -303,6 +433,14 @@ class Countdown(QFrame):
 
 
 class MainWidget(QFrame):
+    shot_taken = pyqtSignal(int)
+    picture_taken = pyqtSignal(object, object, int)
+    print_done = pyqtSignal(object)
+    # The welcome screen is shown and the booth is ready to take photos
+    ready = pyqtSignal()
+    _warmed_up = pyqtSignal(object)
+    _montage_queued = pyqtSignal(object, object)
+
     def __init__(self, parent):
         super().__init__(parent)
         self.setObjectName("MainWidget")
@@ -312,10 +450,19 @@ class MainWidget(QFrame):
         self._btn_photo = PhotoWidget(self)
         self._btn_printer = PrinterWidget(self)
         self._btn_quote = ChangeQuoteWidget(self)
+        self._btn_gallery = GalleryButtonWidget(self)
         self._label = BottomLabel(self)
         self._countdown = Countdown(self)
         self._cheese = Cheese(self)
-        self._preview = Preview(self)
+
+        # Workers and widgets made by the warm-up, see _on_warmed_up()
+        self._print_queue = None
+        self._preview = None
+        self._gallery = None
+        self._gallery_widget = None
+        self._camera = None
+        # Saves the printed pictures, the archive may have to wait for the disk
+        self._archiver = ThreadPoolExecutor(1)
 
         # Inactivity timer
         self._inactivity = QTimer(self)
@@ -323,30 +470,49 @@ class MainWidget(QFrame):
         self._inactivity.setInterval(INACTIVITY_TIMEOUT)
         self._inactivity.timeout.connect(self._on_reset)
 
-        # Process
-        self._camera_task = QProcess(self)
-        self._camera_task.finished.connect(self._on_picture_taken)
-        self._printer_task = QProcess(self)
-        self._printer_task.finished.connect(self._on_print_sent)
-
         # Signals
         self._btn_photo.clicked.connect(self._on_photo_clicked)
         self._btn_printer.clicked.connect(self._on_printer_clicked)
         self._btn_quote.clicked.connect(self._on_make_preview)
+        self._btn_gallery.clicked.connect(self._on_gallery_clicked)
         self._countdown.last_second.connect(self._on_cheese)
         self._cheese.take_picture.connect(self._on_take_picture)
-        self._preview.preview_ready.connect(self._on_preview_ready)
+        self.shot_taken.connect(self._on_shot_taken)
+        self.picture_taken.connect(self._on_picture_taken)
+        self.print_done.connect(self._on_print_done)
+        self._warmed_up.connect(self._on_warmed_up)
+        self._montage_queued.connect(self._on_montage_queued)
+        QApplication.instance().aboutToQuit.connect(self._img.stop)
 
         # Variables
         self._camera_retry_count = 0
-
-        # Init
-        self._on_reset()
+        # Pictures of the photo being taken (BURST_COUNT of them), and the
+        # captures asked to the camera not answered yet. Each photo is a new
+        # session, the results of the previous ones are dropped.
+        self._capturing = False
+        self._session = 0
+        self._pictures = []
+        self._pending_captures = 0
+        # Start of the stages being timed
+        self._marks = {}
+        # Startup steps done, the booth is ready after both
+        self._painted = False
+        self._warm = False
+
+        # Init: the welcome screen, its buttons wait for the warm-up
+        self._show_buttons(True)
+        self._enable_buttons(False)
+        self._label.set_welcome()
+        self._countdown.hide()
+        self._cheese.hide()
 
         # Layout
         grid = QGridLayout()
         grid.addWidget(self._img, 0, 1)
-        grid.addWidget(self._btn_photo, 0, 2)
+        right_grid = QVBoxLayout()
+        right_grid.addWidget(self._btn_photo)
+        right_grid.addWidget(self._btn_gallery)
+        grid.addLayout(right_grid, 0, 2)
         v_grid = QVBoxLayout()
         v_grid.addWidget(self._btn_printer)
         v_grid.addWidget(self._btn_quote)
@@ -354,12 +520,103 @@ class MainWidget(QFrame):
         grid.addWidget(self._label, 1, 0, 1, 3)
         grid.addWidget(self._countdown, 1, 1)
         grid.addWidget(self._cheese, 0, 1)
-        grid.addWidget(self._preview, 0, 1)
         grid.setColumnStretch(0, 1)
         grid.setColumnStretch(2, 1)
         grid.setRowStretch(1, 1)
         self.setLayout(grid)
 
+        # The slow modules are imported in the background, then the devices
+        # are opened in parallel
+        warm_up(["preview", "webcam", "camera"],
+                {"webcam": self._img.open,
+                 "frames": self._load_frames,
+                 "printers": self._start_printers,
+                 "camera": self._start_camera,
+                 "gallery": self._open_gallery}, self._warmed_up.emit)
+
+    @staticmethod
+    def _load_frames():
+        from frames import FrameCatalogue, layout
+        # Frames checked once at startup, then as they are added
+        catalogue = FrameCatalogue(FRAME_DIRECTORY)
+        catalogue.refresh()
+        # Checked now, the booth cannot do without them later on
+        if layout(BURST_COUNT) is None:
+            raise RuntimeError("No window layout for {} pictures, see "
+                               "FRAME_BURST_WINDOWS".format(BURST_COUNT))
+        if not any(len(frame.windows) == BURST_COUNT
+                   for frame in catalogue.frames):
+            raise RuntimeError("No frame for {} pictures in {}".format(
+                BURST_COUNT, FRAME_DIRECTORY))
+        return catalogue
+
+    def _start_printers(self):
+        from printer import PrintQueue, create_printers
+        print_queue = PrintQueue(create_printers(), self.print_done.emit)
+        print_queue.start()
+        return print_queue
+
+    def _start_camera(self):
+        # The signals bring the results back to the GUI thread
+        from camera import CameraService, create_camera
+        camera = CameraService(create_camera(), self.picture_taken.emit,
+                               self.shot_taken.emit)
+        camera.start()
+        camera.connect()
+        return camera
+
+    @staticmethod
+    def _open_gallery():
+        from gallery import Gallery
+        return Gallery()
+
+    def _on_warmed_up(self, futures: dict):
+        start = time.perf_counter()
+        try:
+            opened = futures["webcam"].result()
+        except Exception as e:
+            print("Failed to open the webcam: " + str(e))
+            opened = False
+        self._img.start(opened)
+        try:
+            self._print_queue = futures["printers"].result()
+            self._camera = futures["camera"].result()
+            catalogue = futures["frames"].result()
+            # Photos already taken, for the reprints
+            self._gallery = futures["gallery"].result()
+            from preview import Preview
+        except Exception:
+            # The buttons stay disabled
+            sys.excepthook(*sys.exc_info())
+            self._label.set_startup_error()
+            return
+        self._preview = Preview(self, self._print_queue, catalogue)
+        self._gallery_widget = GalleryWidget(self, self._gallery)
+        self.layout().addWidget(self._preview, 0, 1)
+        self.layout().addWidget(self._gallery_widget, 0, 1)
+        self._preview.picture_ready.connect(self._on_picture_shown)
+        self._preview.draft_ready.connect(self._on_draft_ready)
+        self._preview.preview_ready.connect(self._on_preview_ready)
+        self._preview.saved.connect(self._on_montage_saved)
+        self._gallery_widget.selected.connect(self._on_gallery_selected)
+        self._on_reset()
+        profile.record("widgets", start)
+        self._warm = True
+        self._on_started()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self._painted:
+            profile.record("welcome screen")
+            self._painted = True
+            self._on_started()
+
+    def _on_started(self):
+        if self._painted and self._warm:
+            profile.record("ready")
+            print("Startup profile\n" + profile.report())
+            self.ready.emit()
+
     def _on_reset(self):
         self._img.show()
         self._show_buttons(True)
@@ -369,8 +626,23 @@ class MainWidget(QFrame):
         self._countdown.hide()
         self._cheese.hide()
         self._preview.hide()
+        self._gallery_widget.hide()
+        # Nobody is waiting, good time to write the log
+        self._img.record_stats()
+        metrics.flush()
+
+    def _mark(self, *stages):
+        now = time.perf_counter()
+        for stage in stages:
+            self._marks[stage] = now
+
+    def _record(self, stage, **fields):
+        start = self._marks.pop(stage, None)
+        if start is not None:
+            metrics.record(stage, start, **fields)
 
     def _on_photo_clicked(self):
+        self._mark("booth.countdown")
         self._inactivity.stop()
         self._img.show()
         self._enable_buttons(False)
@@ -379,6 +651,9 @@ class MainWidget(QFrame):
         self._countdown.start(COUNTDOWN_DURATION)
         self._cheese.hide()
         self._preview.hide()
+        self._gallery_widget.hide()
+        # Frames added meanwhile are ready for the picture
+        self._preview.refresh_frames()
 
     def _on_cheese(self):
         self._img.hide()
@@ -389,23 +664,62 @@ class MainWidget(QFrame):
         self._cheese.show()
         self._cheese.start()
 
-    def _on_take_picture(self, retry=False):
-        if not retry:
+    def _on_take_picture(self):
+        if not self._capturing:
+            self._record("booth.countdown")
+            self._mark("booth.capture")
             self._camera_retry_count = 0
-        self._camera_task.start(sys.executable, ["camera.py"])
-
-    def _on_picture_taken(self, ret_code: int):
-        if ret_code == 0:
-            self._on_make_preview(new_picture=True)
+            self._capturing = True
+            self._session += 1
+            self._pictures = []
+            self._pending_captures = 0
+        self._pending_captures += 1
+        self._camera.capture(self._session)
+
+    def _missing_pictures(self) -> int:
+        # Pictures of the burst not asked to the camera yet
+        return (BURST_COUNT - len(self._pictures) - self._pending_captures -
+                self._cheese.counting)
+
+    def _on_shot_taken(self, session: int):
+        # The guest can take the next pose while the picture is transferred
+        if (self._capturing and session == self._session and
+                self._missing_pictures() > 0):
+            self._label.set_next_shot(
+                BURST_COUNT - self._missing_pictures() + 1, BURST_COUNT)
+            self._cheese.start()
+
+    def _on_picture_taken(self, picture, error, session: int):
+        if not self._capturing or session != self._session:
+            return
+        self._pending_captures -= 1
+        if error is None:
+            self._pictures.append(picture)
+            self._preview.add_picture(picture, len(self._pictures) - 1,
+                                      BURST_COUNT)
+            if len(self._pictures) < BURST_COUNT:
+                return
+            self._capturing = False
+            self._record("booth.capture", retries=self._camera_retry_count)
+            self._mark("booth.picture", "booth.draft", "booth.preview")
+            self._on_make_preview(self._pictures)
         else:
-            print(str(self._camera_task.readAllStandardError(), 'utf-8'))
+            print(error)
             self._camera_retry_count += 1
             if self._camera_retry_count < CAMERA_MAX_RETRY:
-                self._on_take_picture(retry=True)
+                # Unless the countdown to the next picture is already running
+                if (not self._cheese.counting and
+                        self._missing_pictures() > 0):
+                    self._on_take_picture()
             else:
+                self._capturing = False
+                self._cheese.stop()
+                self._record("booth.capture",
+                             retries=self._camera_retry_count, failed=True)
                 self._on_error(photo_error=True)
 
     def _on_error(self, photo_error):
+        self._gallery_widget.hide()
         self._show_buttons(True)
         self._enable_buttons(photo_only=True)
         self._label.show()
@@ -417,50 +731,138 @@ class MainWidget(QFrame):
         self._cheese.error()
         self._inactivity.start(ERROR_MSG_TIMEOUT)
 
-    def _on_make_preview(self, new_picture=False):
+    def _on_make_preview(self, pictures=None):
+        if pictures is None:
+            self._mark("booth.frame_change")
         self._inactivity.stop()
         self._show_buttons(True)
         self._enable_buttons(False)
         self._label.hide()
         self._cheese.hide()
         self._preview.show()
-        self._preview.compute(randomized=new_picture)
+        if not self._preview.compute(pictures):
+            # All the frames have been removed or rejected
+            self._preview.hide()
+            self._on_error(photo_error=True)
+
+    def _on_picture_shown(self):
+        self._record("booth.picture")
+        self._label.show()
+        self._label.set_review_picture()
+
+    def _on_draft_ready(self):
+        # The guest can already look at the other frames, printing waits for
+        # the full size montage
+        self._record("booth.draft")
+        self._btn_quote.setEnabled(True)
 
     def _on_preview_ready(self):
+        self._record("booth.preview")
+        self._record("booth.frame_change")
         self._enable_buttons(True)
         self._label.show()
         self._label.set_review_picture()
         self._inactivity.start(INACTIVITY_TIMEOUT)
 
     def _on_printer_clicked(self):
+        if self._gallery_widget.isVisible():
+            self._on_reprint()
+            return
+        self._mark("booth.save")
         self._inactivity.stop()
         self._enable_buttons(False)
         self._label.set_pre_printing()
-        self._printer_task.start(sys.executable, ["printer.py"])
+        self._preview.save()
 
-    def _on_print_sent(self, ret_code: int):
-        if ret_code == 0:
-            self._label.set_printing()
-            self._enable_buttons(photo_only=True)
-            self._inactivity.start(7000)
-        else:
-            print(str(self._printer_task.readAllStandardError(), 'utf-8'))
+    def _on_montage_saved(self, success: bool, print_image, thumbnail):
+        self._record("booth.save", failed=not success)
+        if not success:
+            self._on_error(photo_error=False)
+            return
+        self._archiver.submit(self._print_montage, print_image, thumbnail)
+
+    def _print_montage(self, print_image, thumbnail):
+        # Called from the archiver thread
+        try:
+            job = self._print_queue.save(FRAME_OUT_FILENAME, print_image)
+            # In the gallery even when it cannot be printed
+            self._gallery.add(job.name, thumbnail, print_image)
+            self._print_queue.enqueue(job)
+        except (RuntimeError, OSError) as e:
+            self._montage_queued.emit(None, str(e))
+            return
+        self._montage_queued.emit(job, None)
+
+    def _on_montage_queued(self, job, error):
+        if error is not None:
+            print(error)
             self._on_error(photo_error=False)
+            return
+        self._on_printing(job)
+
+    def _on_printing(self, job):
+        self._label.set_printing(self._print_queue.position(job),
+                                 self._print_queue.eta(job))
+        self._enable_buttons(photo_only=True)
+        self._inactivity.start(7000)
+
+    def _on_gallery_clicked(self):
+        self._inactivity.start(INACTIVITY_TIMEOUT)
+        self._img.hide()
+        self._cheese.hide()
+        self._preview.hide()
+        self._enable_buttons(photo_only=True)
+        self._btn_gallery.setEnabled(False)
+        self._label.show()
+        self._label.set_gallery()
+        self._gallery_widget.show()
+        self._gallery_widget.refresh()
+
+    def _on_gallery_selected(self, _):
+        self._inactivity.start(INACTIVITY_TIMEOUT)
+        self._btn_printer.setEnabled(True)
+
+    def _on_reprint(self):
+        # From the bitmap kept ready for the printer, or from the printed
+        # picture for the older photos
+        from printer import PrintJob
+        self._inactivity.stop()
+        self._enable_buttons(False)
+        entry = self._gallery.entry(self._gallery_widget.selected_slot)
+        job = PrintJob(entry.path, entry.name, copies=PRINTER_COPIES)
+        try:
+            self._print_queue.enqueue(job)
+        except RuntimeError as e:
+            print(str(e))
+            self._on_error(photo_error=False)
+            return
+        self._on_printing(job)
+
+    @staticmethod
+    def _on_print_done(job):
+        # The guest has already been told the picture is being printed
+        if job.error is not None:
+            print(job.error)
 
     def _show_buttons(self, show):
         self._btn_photo.setVisible(show)
         self._btn_printer.setVisible(show)
         self._btn_quote.setVisible(show)
+        self._btn_gallery.setVisible(show)
 
     def _enable_buttons(self, enable=False, photo_only=False):
+        # The gallery replaces the photo being reviewed, it is only offered
+        # when there is none
         if photo_only:
             self._btn_photo.setEnabled(True)
             self._btn_printer.setEnabled(False)
             self._btn_quote.setEnabled(False)
+            self._btn_gallery.setEnabled(True)
         else:
             self._btn_photo.setEnabled(enable)
             self._btn_printer.setEnabled(enable)
             self._btn_quote.setEnabled(enable)
+            self._btn_gallery.setEnabled(False)
 
 
 class MainWindow(QMainWindow):
@@ -479,11 +881,13 @@ if __name__ == '__main__':
     sys.excepthook = except_hook
     root = dirname(__file__)
     os.chdir(root)
-    with open("stylesheet.css") as css_file:
-        stylesheet = css_file.read()
-    app = QApplication(sys.argv)
-    win = MainWindow()
-    win.setStyleSheet(stylesheet)
+    with profile.phase("application"):
+        with open("stylesheet.css") as css_file:
+            stylesheet = css_file.read()
+        app = QApplication(sys.argv)
+    with profile.phase("window"):
+        win = MainWindow()
+        win.setStyleSheet(stylesheet)
     win.showFullScreen()
     ret = app.exec()
     sys.exit(ret)
@@ -0,0 +1,115 @@
+import atexit
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from logging import Formatter, getLogger, INFO
+from logging.handlers import RotatingFileHandler
+from os.path import join, dirname, abspath
+from config import (METRICS_FILENAME, METRICS_FILE_SIZE, METRICS_FILE_COUNT,
+                    METRICS_BUFFER_SIZE)
+
+
+def log_path(filename: str) -> str:
+    # Relative to the booth, wherever it is started from
+    return join(dirname(abspath(__file__)), filename)
+
+
+def percentile(samples: list, p: float) -> float:
+    # Nearest rank
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def summarize(spans) -> list:
+    # (stage, count, p50, p95) for each stage, durations in ms
+    durations = {}
+    for span in spans:
+        durations.setdefault(span["stage"], []).append(span["duration"])
+    return [(stage, len(samples), percentile(samples, 50),
+             percentile(samples, 95))
+            for stage, samples in sorted(durations.items())]
+
+
+def format_summary(summary: list) -> str:
+    lines = ["{:<24} {:>6} {:>10} {:>10}".format("stage", "count",
+                                                 "p50 (ms)", "p95 (ms)")]
+    for stage, count, p50, p95 in summary:
+        lines.append("{:<24} {:>6} {:>10.1f} {:>10.1f}".format(
+            stage, count, p50, p95))
+    return "\n".join(lines)
+
+
+# Durations of the stages of the booth. The latest spans are kept in memory
+# for the summary, and written to a JSON lines log (one span per line) when
+# flush() is called, the log being rotated when it gets too big. Spans can be
+# recorded from any thread.
+class Metrics:
+    def __init__(self, filename: str = METRICS_FILENAME,
+                 capacity: int = METRICS_BUFFER_SIZE):
+        self._spans = deque(maxlen=capacity)
+        self._pending = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._log = None
+        if filename is not None:
+            self._log = getLogger("metrics")
+            self._log.propagate = False
+            self._log.setLevel(INFO)
+            handler = RotatingFileHandler(
+                log_path(filename), maxBytes=METRICS_FILE_SIZE * 1024 * 1024,
+                backupCount=METRICS_FILE_COUNT, delay=True)
+            handler.setFormatter(Formatter("%(message)s"))
+            self._log.addHandler(handler)
+
+    def record(self, stage: str, start: float, **fields):
+        # 'start' is a time.perf_counter() value, the span ends now
+        span = {"time": round(time.time(), 3), "stage": stage,
+                "duration": round((time.perf_counter() - start) * 1000, 2)}
+        span.update(fields)
+        with self._lock:
+            self._spans.append(span)
+            self._pending.append(span)
+
+    @contextmanager
+    def span(self, stage: str, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, **fields)
+
+    def flush(self):
+        with self._lock:
+            spans = list(self._pending)
+            self._pending.clear()
+        if self._log is None:
+            return
+        for span in spans:
+            self._log.info(json.dumps(span))
+
+    def summary(self) -> list:
+        with self._lock:
+            return summarize(list(self._spans))
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
+
+
+if __name__ == "__main__":
+    # Summary of the logs given, or of the current log and its backups
+    filenames = sys.argv[1:]
+    if not filenames and METRICS_FILENAME is not None:
+        filename = log_path(METRICS_FILENAME)
+        filenames = [filename] + [filename + "." + str(i)
+                                  for i in range(1, METRICS_FILE_COUNT + 1)]
+    logged = []
+    for name in filenames:
+        try:
+            with open(name) as f:
+                logged.extend(json.loads(line) for line in f if line.strip())
+        except FileNotFoundError:
+            pass
+    print(format_summary(summarize(logged)))
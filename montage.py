@@ -0,0 +1,258 @@
+import io
+import cv2
+import numpy as np
+from PIL import Image
+from config import FRAMED_PICTURE_SIZE, FRAME_IMAGE_POS, RESAMPLING_PRESET
+
+# Filters of each resampling preset: for the printed bitmap, made once (PIL
+# filter and reducing gap, None for an exact resampling), and for the previews,
+# made for each frame shown (OpenCV interpolation)
+RESAMPLING_PRESETS = {
+    "fast": (Image.BOX, None, cv2.INTER_NEAREST),
+    "balanced": (Image.BILINEAR, 2.0, cv2.INTER_LINEAR),
+    "best": (Image.LANCZOS, None, cv2.INTER_AREA),
+}
+
+# Side of the square tiles of the picture window, classified by the alpha of
+# the frame (in pixels)
+TILE_SIZE = 32
+
+
+def div255(a: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # Same rounding as the blending done by PIL, 'a' is modified in place
+    np.add(a, 128, out=a)
+    np.right_shift(a, 8, out=out)
+    np.add(out, a, out=out)
+    np.right_shift(out, 8, out=out)
+    return out
+
+
+def premultiply(rgba: np.ndarray) -> np.ndarray:
+    # Frame pasted through its alpha channel over a transparent canvas
+    tmp = np.multiply(rgba, rgba[..., 3:], dtype=np.uint16)
+    return div255(tmp, np.empty_like(tmp)).astype(np.uint8)
+
+
+def scaled(size: tuple, scale: float) -> tuple:
+    return tuple(int(v / scale) for v in size)
+
+
+def scaled_window(window: tuple, scale: float,
+                  size: tuple = FRAMED_PICTURE_SIZE) -> tuple:
+    # Window (x, y, width, height) of a frame of 'size' reduced by 'scale',
+    # covering all the pixels it partly covers once reduced
+    reduced = scaled(size, scale)
+    x, y, w, h = window
+    left = x * reduced[0] // size[0]
+    top = y * reduced[1] // size[1]
+    right = -(-(x + w) * reduced[0] // size[0])
+    bottom = -(-(y + h) * reduced[1] // size[1])
+    return left, top, right - left, bottom - top
+
+
+def resample(image: Image.Image, size: tuple, box: tuple = None,
+             preset: str = RESAMPLING_PRESET) -> Image.Image:
+    # The part 'box' of the image (all of it by default) scaled to 'size', in
+    # a single pass
+    if box is None:
+        box = (0, 0) + image.size
+    if size == image.size and tuple(box) == (0, 0) + image.size:
+        return image
+    resample_filter, reducing_gap, _ = RESAMPLING_PRESETS[preset]
+    return image.resize(size, resample_filter, box, reducing_gap)
+
+
+def resample_array(image: np.ndarray, size: tuple,
+                   preset: str = RESAMPLING_PRESET,
+                   printed: bool = False) -> np.ndarray:
+    # The pictures printed are averaged over their area whatever the preset:
+    # the interpolations of the previews skip pixels when reducing a lot
+    if (image.shape[1], image.shape[0]) == size:
+        return image
+    interpolation = RESAMPLING_PRESETS[preset][2]
+    if printed:
+        interpolation = cv2.INTER_AREA
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+def fit_picture(picture: np.ndarray, size: tuple,
+                preset: str = RESAMPLING_PRESET,
+                printed: bool = False) -> np.ndarray:
+    # Picture scaled to fill 'size', the excess being cropped on both sides
+    h, w = picture.shape[:2]
+    scale = max(size[0] / w, size[1] / h)
+    crop_w = min(w, round(size[0] / scale))
+    crop_h = min(h, round(size[1] / scale))
+    x = (w - crop_w) // 2
+    y = (h - crop_h) // 2
+    return np.ascontiguousarray(resample_array(
+        picture[y:y + crop_h, x:x + crop_w], size, preset, printed))
+
+
+def decode_picture(data: bytes, size: tuple = None) -> np.ndarray:
+    # Picture at least as large as 'size' (at full size if None): the JPEG
+    # decoder only computes the reduced picture, by 1/2, 1/4 or 1/8
+    with Image.open(io.BytesIO(data)) as picture:
+        if size is None:
+            size = picture.size
+        elif picture.size[0] < size[0] or picture.size[1] < size[1]:
+            print("Warning: picture from camera smaller than its window, "
+                  "it is enlarged")
+        picture.draft("RGB", size)
+        return np.asarray(picture.convert("RGBA"))
+
+
+def make_montage_pil(picture: Image.Image, frame: Image.Image,
+                     pos: tuple = FRAME_IMAGE_POS) -> Image.Image:
+    # Reference implementation of the montage, with PIL operations only
+    output = Image.new('RGBA', frame.size)
+    output.paste(picture, pos)
+    output.paste(frame, (0, 0), frame)
+    return output
+
+
+def as_pixels(rgba: np.ndarray) -> np.ndarray:
+    # One uint32 per RGBA pixel, to move whole pixels at once
+    return rgba.reshape(-1, 4).view(np.uint32).reshape(-1)
+
+
+def tile_runs(tiles: np.ndarray, shape: tuple) -> list:
+    # Rectangles covering the True tiles, as (rows, columns) slices clipped to
+    # 'shape': horizontal runs of tiles, merged with the identical runs of the
+    # following rows of tiles
+    rectangles = []
+    previous = []
+    for ty in range(tiles.shape[0]):
+        row = np.concatenate(([False], tiles[ty], [False]))
+        edges = np.flatnonzero(row[1:] != row[:-1]).reshape(-1, 2)
+        runs = [(int(start), int(stop)) for start, stop in edges]
+        if runs == [run for run, _ in previous]:
+            for _, rows in previous:
+                rows[1] = ty + 1
+        else:
+            previous = [(run, [ty, ty + 1]) for run in runs]
+            rectangles.extend(previous)
+    return [(slice(rows[0] * TILE_SIZE, min(rows[1] * TILE_SIZE, shape[0])),
+             slice(start * TILE_SIZE, min(stop * TILE_SIZE, shape[1])))
+            for (start, stop), rows in rectangles]
+
+
+# Frame prepared for the montage of a picture of a given size, at a given
+# position. Everything depending only on the frame is computed here once: the
+# canvas outside of the picture window (which can be shared by the layers of a
+# frame), and how each tile of the window is made. Where the frame is opaque,
+# the tile is already right in the canvas; where it is transparent, the tile is
+# copied from the picture. The tiles mixing both are copied from the picture
+# too, then their opaque pixels are restored and only their semi-transparent
+# ones are blended. Like PIL, the blending lowers the alpha of the result,
+# unless 'opaque_alpha' is set: the result is then opaque wherever the picture
+# shows.
+class FrameLayer:
+    def __init__(self, rgba: np.ndarray, pos: tuple, picture_shape: tuple,
+                 base: np.ndarray = None, opaque_alpha: bool = False):
+        canvas_h, canvas_w = rgba.shape[:2]
+        x0, y0 = pos
+        y1 = max(y0, min(y0 + picture_shape[0], canvas_h))
+        x1 = max(x0, min(x0 + picture_shape[1], canvas_w))
+        self.window = (slice(y0, y1), slice(x0, x1))
+        self.base = premultiply(rgba) if base is None else base
+
+        # Alpha range of each tile of the window
+        window_a = rgba[self.window][..., 3]
+        tile_rows = np.arange(0, y1 - y0, TILE_SIZE)
+        tile_columns = np.arange(0, x1 - x0, TILE_SIZE)
+        if len(tile_rows) and len(tile_columns):
+            low = np.minimum.reduceat(np.minimum.reduceat(
+                window_a, tile_rows, axis=0), tile_columns, axis=1)
+            high = np.maximum.reduceat(np.maximum.reduceat(
+                window_a, tile_rows, axis=0), tile_columns, axis=1)
+        else:
+            low = high = np.zeros((len(tile_rows), len(tile_columns)),
+                                  np.uint8)
+        opaque = low == 255
+        mixed = ~opaque & (high > 0)
+        self.tiles = (int((high == 0).sum()), int(opaque.sum()),
+                      int(mixed.sum()))
+
+        # Areas of the window copied from the picture
+        self.picture_runs = tile_runs(~opaque, window_a.shape)
+
+        # Pixels of the mixed tiles where the frame is opaque, and where it is
+        # blended over the picture
+        in_mixed = np.repeat(np.repeat(mixed, TILE_SIZE, axis=0), TILE_SIZE,
+                             axis=1)[:window_a.shape[0], :window_a.shape[1]]
+        ys, xs = np.nonzero(in_mixed & (window_a == 255))
+        self.opaque_index = (ys + y0) * canvas_w + (xs + x0)
+        self.opaque_pixels = as_pixels(self.base)[self.opaque_index]
+        ys, xs = np.nonzero(in_mixed & (window_a > 0) & (window_a < 255))
+        self.canvas_index = (ys + y0) * canvas_w + (xs + x0)
+        self.picture_index = ys * picture_shape[1] + xs
+        a = window_a[ys, xs][:, np.newaxis].astype(np.uint16)
+        self.inv_alpha = 255 - a
+        self.frame_term = np.multiply(rgba[self.window][ys, xs], a,
+                                      dtype=np.uint16)
+        if opaque_alpha:
+            self.frame_term[:, 3] = 255 * a[:, 0]
+
+        self.nbytes = (self.opaque_index.nbytes + self.opaque_pixels.nbytes +
+                       self.canvas_index.nbytes + self.picture_index.nbytes +
+                       self.inv_alpha.nbytes + self.frame_term.nbytes)
+        if base is None:
+            self.nbytes += self.base.nbytes
+
+
+# Montage of the pictures with a frame, done on NumPy arrays. Each picture is
+# fitted to its window of the frame (see Frame.windows), and must be RGBA with
+# an opaque alpha channel. For a single picture of the size of the window, the
+# result is identical to make_montage_pil(). All the buffers are allocated once
+# and reused for each montage: the returned array is overwritten by the next
+# call.
+class Compositor:
+    def __init__(self, size: tuple = FRAMED_PICTURE_SIZE):
+        self._canvas = np.zeros((size[1], size[0], 4), np.uint8)
+        self._capacity = 0
+
+    def _alloc_blend(self, n: int):
+        if n > self._capacity:
+            self._capacity = n
+            self._pixels = np.empty((n, 4), np.uint8)
+            self._blend = np.empty((n, 4), np.uint16)
+            self._blend_tmp = np.empty((n, 4), np.uint16)
+
+    def compose(self, pictures: list, frame) -> np.ndarray:
+        if len(pictures) != len(frame.windows):
+            raise ValueError("{} pictures for a frame with {} windows".format(
+                len(pictures), len(frame.windows)))
+        canvas = self._canvas
+        if canvas.shape != frame.base.shape:
+            canvas = self._canvas = np.empty_like(frame.base)
+        np.copyto(canvas, frame.base)
+        for picture, (x, y, w, h) in zip(pictures, frame.windows):
+            picture = fit_picture(picture, (w, h))
+            self._compose_window(canvas, picture,
+                                 frame.layer((x, y), picture.shape))
+        return canvas
+
+    def _compose_window(self, canvas: np.ndarray, picture: np.ndarray,
+                        layer: FrameLayer):
+        window = canvas[layer.window]
+        for rows, columns in layer.picture_runs:
+            np.copyto(window[rows, columns], picture[rows, columns])
+        as_pixels(canvas)[layer.opaque_index] = layer.opaque_pixels
+
+        # Where the frame is semi-transparent, for all channels (including
+        # alpha, the picture being opaque): picture * (255 - a) + frame * a
+        n = len(layer.canvas_index)
+        if n == 0:
+            return
+        self._alloc_blend(n)
+        pixels = self._pixels[:n]
+        blend = self._blend[:n]
+        np.take(as_pixels(picture), layer.picture_index,
+                out=pixels.view(np.uint32).reshape(-1))
+        np.multiply(pixels, layer.inv_alpha, out=blend)
+        np.add(blend, layer.frame_term, out=blend)
+        np.copyto(pixels, div255(blend, self._blend_tmp[:n]),
+                  casting="unsafe")
+        as_pixels(canvas)[layer.canvas_index] = pixels.view(
+            np.uint32).reshape(-1)
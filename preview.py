@@ -0,0 +1,321 @@
+import threading
+import numpy as np
+from PyQt5.QtCore import pyqtSignal, QSize, QTimer
+from PyQt5.QtGui import QImage, QPixmap, QIcon
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor, Future
+from random import randrange
+from PIL import Image
+from printer import prepare_print_image
+from frames import FrameCache, FrameInfo, PREVIEW_SCALE, layout
+from gallery import make_thumbnail
+from montage import (Compositor, decode_picture, fit_picture, resample_array,
+                     scaled, scaled_window)
+from metrics import metrics
+from widgets import CentralWidget
+from config import (PREVIEW_DRAFT_SCALE, RESAMPLING_PRESET,
+                    FRAMED_PICTURE_SIZE, FRAME_OUT_FILENAME,
+                    FRAME_OUT_COMPRESS_LEVEL, FRAME_OUT_SAVE_DELAY,
+                    PRERENDER_COUNT, PRERENDER_WORKERS)
+
+
+def preview_image(montage: np.ndarray, size: QSize,
+                  preset: str = RESAMPLING_PRESET) -> QImage:
+    # Cropped to the aspect ratio of the preview and scaled in one pass
+    h, w = montage.shape[:2]
+    cropped_w = round(h * size.width() / size.height())
+    x = (w - cropped_w) // 2
+    image = resample_array(montage[:, x:x + cropped_w],
+                           (size.width(), size.height()), preset)
+    if not image.flags.c_contiguous:
+        image = np.ascontiguousarray(image)
+    return QImage(image, image.shape[1], image.shape[0], image.shape[1] * 4,
+                  QImage.Format_RGBA8888).copy()
+
+
+class Preview(CentralWidget):
+    picture_ready = pyqtSignal()
+    draft_ready = pyqtSignal()
+    preview_ready = pyqtSignal()
+    saved = pyqtSignal(bool, object, object)
+    _rendered = pyqtSignal(int, int, int, QImage)
+
+    # Successive images shown for a new picture
+    STAGE_WAIT = 0
+    STAGE_PICTURE = 1
+    STAGE_DRAFT = 2
+    STAGE_FULL = 3
+
+    def __init__(self, parent, print_queue, catalogue):
+        super().__init__(parent)
+        self._print_queue = print_queue
+        # Previews are rendered in advance for the next frames, by a pool of
+        # threads having their own Compositor
+        self._pool = ThreadPoolExecutor(PRERENDER_WORKERS)
+        self._writer = ThreadPoolExecutor(1)
+        # The new frames are checked in the background, see refresh_frames()
+        self._refresher = ThreadPoolExecutor(1)
+        self._refresh = None
+        self._local = threading.local()
+        self._rendered.connect(self._on_rendered)
+        # The montage is written on disk in advance, when the guest keeps
+        # looking at it and is likely to print it
+        self._save_timer = QTimer(self)
+        self._save_timer.setSingleShot(True)
+        self._save_timer.setInterval(FRAME_OUT_SAVE_DELAY)
+        self._save_timer.timeout.connect(self._save_current)
+        self._icon = QIcon(join("assets", "wait.svg"))
+        self._current_frame = 0
+        self._frames = []
+        self._frame_cache = FrameCache()
+        # Frames available, checked by the catalogue given by the booth
+        self._catalogue = catalogue
+        self._generation = 0
+        # JPEG data of the pictures, and the windows of their frames (at full
+        # size)
+        self._data = []
+        self._windows = []
+        # Pictures decoded at the size of the previews, and at full size (only
+        # once the previews are done, for the montage printed)
+        self._pictures = []
+        self._full_pictures = None
+        # Pictures being decoded before the preview is computed, by id
+        self._decoding = {}
+        self._jobs = {}
+        self._previews = {}
+        self._stage = self.STAGE_WAIT
+        self._saved = None
+        self._saved_key = None
+
+    def refresh_frames(self):
+        # Checks the frames added or modified, for the next photos: checking a
+        # frame takes too long to be done when the picture arrives
+        if self._refresh is None or self._refresh.done():
+            self._refresh = self._refresher.submit(self._catalogue.refresh)
+
+    def _new_frame(self, count: int) -> bool:
+        # Frames with a window for each picture, False if there are none
+        self._frames = [frame for frame in self._catalogue.frames
+                        if len(frame.windows) == count]
+        if not self._frames:
+            return False
+        self._current_frame = randrange(len(self._frames))
+        return True
+
+    def _next_frame(self):
+        self._current_frame += 1
+        if self._current_frame >= len(self._frames):
+            self._current_frame = 0
+
+    def add_picture(self, picture, index: int, count: int):
+        # Picture 'index' of 'count', decoded as soon as it is taken, while the
+        # next pictures of a burst are being taken
+        size = scaled_window(layout(count)[index], PREVIEW_SCALE)[2:]
+        self._decoding[id(picture)] = (
+            picture, self._pool.submit(self._decode, picture.data, size,
+                                       "montage.preview_decode"))
+
+    def compute(self, pictures: list = None) -> bool:
+        # False when no frame can show the pictures
+        self._stage = self.STAGE_WAIT
+        if pictures is not None:
+            if not self._new_frame(len(pictures)):
+                print("No frame for {} picture(s)".format(len(pictures)))
+                self._drop_results()
+                self._decoding.clear()
+                return False
+            self._new_pictures(pictures)
+        else:
+            self._next_frame()
+        self._prerender()
+        if pictures is not None:
+            # Queued after the previews, which do not need it
+            self._decode_full()
+        preview = self._previews.get(self._current_frame)
+        if preview is None:
+            self._img.setPixmap(self._icon.pixmap(self._img.size() / 2))
+        else:
+            self._show(self.STAGE_FULL, preview)
+        return True
+
+    def save(self):
+        # Emits 'saved' once the montage is written on disk, with the bitmap
+        # ready for the printer (None if the printer was not known yet) and
+        # the thumbnail for the gallery
+        self._save_timer.stop()
+        self._save_current()
+        self._saved.add_done_callback(self._on_saved)
+
+    def _drop_results(self):
+        # Results for the previous pictures are dropped, running jobs included
+        self._generation += 1
+        for job in self._jobs.values():
+            job.cancel()
+        self._jobs.clear()
+        self._previews.clear()
+
+    def _new_pictures(self, pictures: list):
+        self._drop_results()
+        self._windows = layout(len(pictures))
+        self._full_pictures = None
+        self._data = [picture.data for picture in pictures]
+        # The reduced pictures and montage are shown while waiting for the
+        # preview
+        if PREVIEW_DRAFT_SCALE > 1:
+            self._pool.submit(self._render_draft, self._generation,
+                              self._current_frame,
+                              self._frames[self._current_frame], self._data,
+                              self._sizes(PREVIEW_DRAFT_SCALE))
+        # Decoded only once, in parallel, unless already done by add_picture()
+        decoding = self._decoding
+        self._decoding = {}
+        self._pictures = [
+            decoding[id(picture)][1] if id(picture) in decoding else
+            self._pool.submit(self._decode, picture.data, size,
+                              "montage.preview_decode")
+            for picture, size in zip(pictures, self._sizes(PREVIEW_SCALE))]
+
+    def _sizes(self, scale: float) -> list:
+        # Size of the windows of the pictures in the frames reduced by 'scale'
+        return [scaled_window(window, scale)[2:] for window in self._windows]
+
+    def _decode_full(self):
+        if self._full_pictures is None:
+            self._full_pictures = [
+                self._pool.submit(self._decode, data, size, printed=True)
+                for data, size in zip(self._data, self._sizes(1))]
+
+    def _prerender(self):
+        count = len(self._frames)
+        if 0 < PRERENDER_COUNT < count:
+            count = PRERENDER_COUNT
+        wanted = [(self._current_frame + i) % len(self._frames)
+                  for i in range(count)]
+        for index in list(self._jobs):
+            if index not in wanted:
+                self._jobs.pop(index).cancel()
+                self._previews.pop(index, None)
+        for index in wanted:
+            if index not in self._jobs:
+                self._jobs[index] = self._pool.submit(
+                    self._render, self._generation, index,
+                    self._frames[index], self._pictures)
+
+    def _compositor(self, scale: float) -> Compositor:
+        # One for each scale in each thread
+        if not hasattr(self._local, "compositors"):
+            self._local.compositors = {}
+        compositor = self._local.compositors.get(scale)
+        if compositor is None:
+            compositor = self._local.compositors[scale] = Compositor(
+                scaled(FRAMED_PICTURE_SIZE, scale))
+        return compositor
+
+    @staticmethod
+    def _decode(data: bytes, size: tuple, stage: str = "montage.decode",
+                printed: bool = False) -> np.ndarray:
+        # Fitted to its window once, instead of for each montage
+        with metrics.span(stage):
+            return fit_picture(decode_picture(data, size), size,
+                               printed=printed)
+
+    def _compose(self, frame, pictures: list,
+                 stage: str = "montage.compose") -> np.ndarray:
+        pictures = [picture.result() for picture in pictures]
+        with metrics.span(stage, pictures=len(pictures)):
+            return self._compositor(frame.scale).compose(pictures, frame)
+
+    def _render_draft(self, generation: int, index: int, frame: FrameInfo,
+                      data: list, sizes: list):
+        try:
+            pictures = []
+            for picture_data, size in zip(data, sizes):
+                with metrics.span("montage.draft_decode"):
+                    pictures.append(decode_picture(picture_data, size))
+                if len(pictures) == 1:
+                    # The first picture is shown while the others decode
+                    self._rendered.emit(generation, index, self.STAGE_PICTURE,
+                                        preview_image(pictures[0],
+                                                      self._size))
+            with metrics.span("montage.draft_compose"):
+                draft = self._frame_cache.get(frame).draft
+                montage = self._compositor(draft.scale).compose(pictures,
+                                                                draft)
+            self._rendered.emit(generation, index, self.STAGE_DRAFT,
+                                preview_image(montage, self._size))
+        except Exception as e:
+            print("Failed to render the draft preview: " + str(e))
+
+    def _render(self, generation: int, index: int, frame: FrameInfo,
+                pictures: list):
+        try:
+            montage = self._compose(self._frame_cache.get(frame).preview,
+                                    pictures, "montage.preview_compose")
+            with metrics.span("preview.scale"):
+                image = preview_image(montage, self._size)
+        except Exception as e:
+            print("Failed to render " + frame.path + ": " + str(e))
+            image = QImage()
+        self._rendered.emit(generation, index, self.STAGE_FULL, image)
+
+    def _save(self, frame: FrameInfo, pictures: list):
+        try:
+            montage = self._compose(self._frame_cache.get(frame),
+                                    pictures)
+            image = Image.fromarray(montage, "RGBA")
+            with metrics.span("montage.save"):
+                image.save(FRAME_OUT_FILENAME,
+                           compress_level=FRAME_OUT_COMPRESS_LEVEL)
+            thumbnail = make_thumbnail(montage)
+        except Exception as e:
+            print("Failed to save the montage: " + str(e))
+            return False, None, None
+        # Prepared here too, so that printing only has to send it
+        caps = self._print_queue.caps
+        if caps is None:
+            return True, None, thumbnail
+        try:
+            with metrics.span("printer.prepare"):
+                return True, prepare_print_image(image, caps), thumbnail
+        except Exception as e:
+            print("Failed to prepare the montage for printing: " + str(e))
+            return True, None, thumbnail
+
+    def _save_current(self):
+        key = (self._generation, self._current_frame)
+        if self._saved_key == key:
+            return
+        if self._saved is not None:
+            self._saved.cancel()
+        self._saved_key = key
+        self._decode_full()
+        self._saved = self._writer.submit(
+            self._save, self._frames[self._current_frame],
+            self._full_pictures)
+
+    def _on_saved(self, saved: Future):
+        # Called from the writer thread, the signal is queued
+        if not saved.cancelled():
+            self.saved.emit(*saved.result())
+
+    def _on_rendered(self, generation: int, index: int, stage: int,
+                     image: QImage):
+        if generation != self._generation:
+            return
+        if stage == self.STAGE_FULL:
+            if index not in self._jobs:
+                return
+            self._previews[index] = image
+        if index == self._current_frame and stage > self._stage:
+            self._show(stage, image)
+
+    def _show(self, stage: int, image: QImage):
+        self._stage = stage
+        self._img.setPixmap(QPixmap.fromImage(image))
+        if stage == self.STAGE_PICTURE:
+            self.picture_ready.emit()
+        elif stage == self.STAGE_DRAFT:
+            self.draft_ready.emit()
+        else:
+            self._save_timer.start()
+            self.preview_ready.emit()
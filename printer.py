@@ -1,102 +1,440 @@
-import win32con
-import win32ui
-import win32print
-from PIL import Image, ImageWin
+import threading
 import datetime
-import shutil
+import time
 import os
 import sys
+import random
+from collections import deque
 from os.path import join, splitext
-from config import PRINTER_NAME, PRINTER_OUT_DIRECTORY, FRAME_OUT_FILENAME
+from PIL import Image
+import archive
+from montage import resample
+from metrics import metrics
+from config import (PRINTER_BACKEND, PRINTER_NAMES, PRINTER_OUT_DIRECTORY,
+                    PRINTER_PRINT_DURATION, PRINTER_PRINT_DURATIONS,
+                    PRINTER_STATUS_INTERVAL,
+                    PRINTER_FILE_DIRECTORY, PRINTER_FILE_DELAY,
+                    PRINTER_FILE_FAILURE_RATE, PRINTER_FILE_OUTAGE_RATE,
+                    PRINTER_FILE_OUTAGE_DURATION,
+                    PRINTER_COPIES, FRAME_OUT_FILENAME, FRAMED_PICTURE_SIZE,
+                    RESAMPLING_PRESET)
 
 
-def save_picture() -> str:
-    index = len(next(os.walk(PRINTER_OUT_DIRECTORY))[2])
-    _, ext = splitext(FRAME_OUT_FILENAME)
-    filename = str(index) + datetime.datetime.now().strftime("-%H-%M-%S") + ext
-    shutil.copy(FRAME_OUT_FILENAME, join(PRINTER_OUT_DIRECTORY, filename))
-    return filename
+_printed = archive.Sequence(PRINTER_OUT_DIRECTORY)
 
 
-def check_printer():
-    # https://stackoverflow.com/questions/12041648/python-win32print-printer-status-confusion
-    printer_handler = win32print.OpenPrinter(PRINTER_NAME)
-    try:
-        printer_info = win32print.GetPrinter(printer_handler)[13]
-        if (printer_info & 0x00000400) >> 10:
-            raise RuntimeError("Printer not connected or turned off")
-    finally:
-        win32print.ClosePrinter(printer_handler)
-
+def save_picture(filename: str = FRAME_OUT_FILENAME) -> str:
+    # The file has just been written, it is read back from the cache. Its copy
+    # is written in the background.
+    with open(filename, "rb") as f:
+        data = f.read()
+    _, ext = splitext(filename)
+    time_str = datetime.datetime.now().strftime("-%H-%M-%S")
+    name = _printed.reserve(lambda index: str(index) + time_str + ext)
+    archive.writer.write(join(PRINTER_OUT_DIRECTORY, name), data)
+    return name
 
-def print_picture(name: str):
-    # https://stackoverflow.com/questions/54522120/python3-print-landscape-image-file-with-specified-printer
-
-    # Open image to be printed
-    img = Image.open(FRAME_OUT_FILENAME)
-    img_width, img_height = img.size
 
-    # Create Device Context (DC)
-    hdc = win32ui.CreateDC()
-    hdc.CreatePrinterDC(PRINTER_NAME)
+class PrinterCaps:
+    def __init__(self, h_res: int, v_res: int):
+        # Printable area (in pixels)
+        self.size = (h_res, v_res)
+        self.landscape = h_res > v_res
 
-    # Read printer capabilities
-    h_res = hdc.GetDeviceCaps(win32con.HORZRES)
-    v_res = hdc.GetDeviceCaps(win32con.VERTRES)
-    h_phy_res = hdc.GetDeviceCaps(win32con.PHYSICALWIDTH)
-    v_phy_res = hdc.GetDeviceCaps(win32con.PHYSICALHEIGHT)
 
-    # Check that the printable area is the full physical area (no margins)
-    if h_res < h_phy_res or v_res < v_phy_res:
-        raise RuntimeError("Printer has margins, change this setting in the "
-                           "Windows control panel.")
+def prepare_print_image(image: Image.Image, caps: PrinterCaps,
+                        preset: str = RESAMPLING_PRESET) -> Image.Image:
+    # Bitmap at the resolution and orientation of the printer, so that the
+    # printer driver only has to copy it
+    img = image.convert("RGB")
+    h_res, v_res = caps.size
 
     # Rotate the image if needed
-    landscape = h_res > v_res
-    if landscape:
-        if img_height > img_width:
+    if caps.landscape:
+        if img.height > img.width:
             # Printer in landscape mode, tall image: rotate bitmap.
-            img = img.rotate(90, expand=True)
+            img = img.transpose(Image.ROTATE_90)
     else:
-        if img_height < img_width:
+        if img.height < img.width:
             # Printer in portrait mode, wide image: rotate bitmap.
-            img = img.rotate(90, expand=True)
+            img = img.transpose(Image.ROTATE_90)
     img_width, img_height = img.size
 
-    if landscape:
-        # We want the image width to match the page width (potentially cropping
-        # the top and bottom of the image)
-        max_width = img_width
-        max_height = round(img_width * v_res / h_res)
+    if caps.landscape:
+        # We want the image width to match the page width (potentially
+        # cropping the top and bottom of the image)
+        scale = h_res / img_width
     else:
         # We want the image height to match the page height (potentially
         # cropping the left and right of the image)
-        max_height = img_height
-        max_width = round(max_height * h_res / v_res)
+        scale = v_res / img_height
+
+    # Only the part of the image on the page is resampled
+    visible_width = min(img_width, h_res / scale)
+    visible_height = min(img_height, v_res / scale)
+    box = ((img_width - visible_width) / 2, (img_height - visible_height) / 2,
+           (img_width + visible_width) / 2, (img_height + visible_height) / 2)
+    size = (min(h_res, round(visible_width * scale)),
+            min(v_res, round(visible_height * scale)))
+    img = resample(img, size, box, preset)
+
+    # Image centered on the page
+    if img.size == caps.size:
+        return img
+    page = Image.new("RGB", caps.size, "white")
+    page.paste(img, ((h_res - size[0]) // 2, (v_res - size[1]) // 2))
+    return page
+
+
+class Win32Printer:
+    def __init__(self, printer_name: str = PRINTER_NAMES[0],
+                 print_duration: float = PRINTER_PRINT_DURATION):
+        # Imported here so that the file backend works without pywin32
+        import win32con
+        import win32ui
+        import win32print
+        from PIL import ImageWin
+        self._win32con = win32con
+        self._win32ui = win32ui
+        self._win32print = win32print
+        self._image_win = ImageWin
+        self._caps = None
+        self.name = printer_name
+        # Time the printer takes for a page once sent (in seconds)
+        self.print_duration = print_duration
+
+    def check(self):
+        # https://stackoverflow.com/questions/12041648/python-win32print-printer-status-confusion
+        printer_handler = self._win32print.OpenPrinter(self.name)
+        try:
+            printer_info = self._win32print.GetPrinter(printer_handler)[13]
+            if (printer_info & 0x00000400) >> 10:
+                raise RuntimeError("Printer not connected or turned off")
+        finally:
+            self._win32print.ClosePrinter(printer_handler)
+
+    def caps(self) -> PrinterCaps:
+        # Read only once, the printer settings do not change while running
+        if self._caps is not None:
+            return self._caps
+        win32con = self._win32con
+        hdc = self._win32ui.CreateDC()
+        hdc.CreatePrinterDC(self.name)
+        try:
+            h_res = hdc.GetDeviceCaps(win32con.HORZRES)
+            v_res = hdc.GetDeviceCaps(win32con.VERTRES)
+            h_phy_res = hdc.GetDeviceCaps(win32con.PHYSICALWIDTH)
+            v_phy_res = hdc.GetDeviceCaps(win32con.PHYSICALHEIGHT)
+        finally:
+            hdc.DeleteDC()
+
+        # Check that the printable area is the full physical area (no margins)
+        if h_res < h_phy_res or v_res < v_phy_res:
+            raise RuntimeError("Printer has margins, change this setting in "
+                               "the Windows control panel.")
+        self._caps = PrinterCaps(h_res, v_res)
+        return self._caps
+
+    def print_image(self, image: Image.Image, name: str, copies: int = 1):
+        # https://stackoverflow.com/questions/54522120/python3-print-landscape-image-file-with-specified-printer
+        # The image comes from prepare_print_image(), it is drawn as is
+        hdc = self._win32ui.CreateDC()
+        hdc.CreatePrinterDC(self.name)
+        try:
+            hdc.StartDoc(name)
+            dib = self._image_win.Dib(image)
+            for _ in range(copies):
+                hdc.StartPage()
+                dib.draw(hdc.GetHandleOutput(), (0, 0) + image.size)
+                hdc.EndPage()
+            hdc.EndDoc()
+        finally:
+            hdc.DeleteDC()
+
+
+class FilePrinter:
+    # Fake printer: the pictures are copied to a directory instead. Some prints
+    # can fail, or turn the printer off for a while, to simulate the outages of
+    # real printers.
+    def __init__(self, directory: str = PRINTER_FILE_DIRECTORY,
+                 name: str = None,
+                 print_duration: float = PRINTER_PRINT_DURATION,
+                 delay: float = PRINTER_FILE_DELAY,
+                 failure_rate: float = PRINTER_FILE_FAILURE_RATE,
+                 outage_rate: float = PRINTER_FILE_OUTAGE_RATE,
+                 outage_duration: float = PRINTER_FILE_OUTAGE_DURATION,
+                 size: tuple = FRAMED_PICTURE_SIZE):
+        self.name = name or "File printer (" + directory + ")"
+        self.print_duration = print_duration
+        self._directory = directory
+        self._delay = delay
+        self._failure_rate = failure_rate
+        self._outage_rate = outage_rate
+        self._outage_duration = outage_duration
+        self._offline_until = 0.0
+        self._caps = PrinterCaps(*size)
+
+    def check(self):
+        if time.monotonic() < self._offline_until:
+            raise RuntimeError("Printer not connected or turned off")
+
+    def caps(self) -> PrinterCaps:
+        return self._caps
+
+    def print_image(self, image: Image.Image, name: str, copies: int = 1):
+        if image.size != self._caps.size:
+            raise RuntimeError("Image not prepared for the printer")
+        time.sleep(self._delay * copies)
+        if random.random() < self._outage_rate:
+            self._offline_until = time.monotonic() + self._outage_duration
+            raise RuntimeError("Printer turned off while printing")
+        if random.random() < self._failure_rate:
+            raise RuntimeError("File printer error")
+        os.makedirs(self._directory, exist_ok=True)
+        image.save(join(self._directory, name))
+
+
+def create_printers(backend: str = PRINTER_BACKEND,
+                    names: list = PRINTER_NAMES) -> list:
+    # One printer for each name, the file backend using a directory for each
+    durations = [PRINTER_PRINT_DURATIONS.get(name, PRINTER_PRINT_DURATION)
+                 for name in names]
+    if backend == "win32":
+        return [Win32Printer(name, duration)
+                for name, duration in zip(names, durations)]
+    if backend == "file":
+        return [FilePrinter(join(PRINTER_FILE_DIRECTORY, str(i)), name,
+                            duration)
+                for i, (name, duration) in enumerate(zip(names, durations))]
+    raise ValueError("Unknown printer backend: " + backend)
+
+
+# Status of the printer, refreshed in the background so that submitting a job
+# never waits for the printer driver
+class PrinterStatus(threading.Thread):
+    def __init__(self, printer, interval: float = PRINTER_STATUS_INTERVAL):
+        super().__init__(daemon=True)
+        self._printer = printer
+        self._interval = interval
+        self._refresh = threading.Event()
+        self.error = None
+        self.caps = None
+
+    def refresh(self):
+        self._refresh.set()
+
+    def run(self):
+        while True:
+            try:
+                self._printer.check()
+                if self.caps is None:
+                    self.caps = self._printer.caps()
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+            self._refresh.wait(self._interval)
+            self._refresh.clear()
+
+
+class PrintJob:
+    def __init__(self, filename: str, name: str, image: Image.Image = None,
+                 copies: int = 1):
+        self.filename = filename
+        self.name = name
+        # Bitmap ready for the printer, made from the file when missing
+        self.image = image
+        self.copies = copies
+        self.error = None
+        self.submitted = time.perf_counter()
+        # Printer worker the job is queued on, and those it failed on
+        self.worker = None
+        self.failed_on = set()
+
+
+# Long-lived worker sending the print jobs of one printer, one at a time: a job
+# is sent once the printer is expected to be done with the previous one. The
+# jobs are given by the PrintQueue, which shares its lock with the workers.
+class PrinterWorker(threading.Thread):
+    def __init__(self, printer, queue, status_interval: float):
+        super().__init__(daemon=True)
+        self.printer = printer
+        self.status = PrinterStatus(printer, status_interval)
+        self.jobs = deque()
+        self.current = None
+        self.busy_until = 0.0
+        self._queue = queue
+        self._condition = queue.condition
+
+    def start(self):
+        self.status.start()
+        super().start()
+
+    @property
+    def online(self) -> bool:
+        return self.status.error is None
+
+    def backlog(self, job: PrintJob = None) -> float:
+        # Time until the printer is done with the jobs before 'job', all of
+        # them if None (in seconds). The lock must be held.
+        backlog = max(0.0, self.busy_until - time.monotonic())
+        if job is not None and job is self.current:
+            return backlog
+        if self.current is not None:
+            backlog += self.current.copies * self.printer.print_duration
+        for waiting in self.jobs:
+            if waiting is job:
+                break
+            backlog += waiting.copies * self.printer.print_duration
+        return backlog
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self.jobs:
+                    self._condition.wait()
+            # The printer is still busy with the previous job
+            time.sleep(max(0.0, self.busy_until - time.monotonic()))
+            with self._condition:
+                if not self.jobs:
+                    # Given to another printer meanwhile
+                    continue
+                self.current = self.jobs.popleft()
+            job = self.current
+            try:
+                self.printer.check()
+                caps = self.printer.caps()
+                if job.image is None or job.image.size != caps.size:
+                    archive.writer.flush()
+                    with metrics.span("printer.prepare"), \
+                            Image.open(job.filename) as image:
+                        job.image = prepare_print_image(image, caps)
+                with metrics.span("printer.spool", copies=job.copies,
+                                  printer=self.printer.name):
+                    self.printer.print_image(job.image, job.name,
+                                             job.copies)
+            except Exception as e:
+                job.error = "[print] " + self.printer.name + ": " + str(e)
+                # Offline until its status says otherwise
+                self.status.error = str(e)
+                self.status.refresh()
+            metrics.record("printer.job", job.submitted,
+                           printer=self.printer.name,
+                           failed=job.error is not None)
+            with self._condition:
+                self.current = None
+                if job.error is None:
+                    self.busy_until = (time.monotonic() + job.copies *
+                                       self.printer.print_duration)
+            if job.error is None or not self._queue.reassign(self, job):
+                self._queue.callback(job)
+
+
+# Print jobs shared by several printers: each job goes to the printer expected
+# to print it first, among those online. The online state comes from the
+# status of each printer, polled in the background. When a print fails, the
+# job goes to another printer, with the jobs waiting for the failed one.
+# 'callback' is called from the worker threads with each job sent, or failed
+# on all the printers.
+class PrintQueue:
+    def __init__(self, printers: list, callback,
+                 status_interval: float = PRINTER_STATUS_INTERVAL):
+        self.callback = callback
+        self.condition = threading.Condition()
+        self.workers = [PrinterWorker(printer, self, status_interval)
+                        for printer in printers]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def caps(self) -> PrinterCaps:
+        # Capabilities of the first printer known, None before any answered
+        for worker in self.workers:
+            if worker.status.caps is not None:
+                return worker.status.caps
+        return None
+
+    @staticmethod
+    def save(filename: str, image: Image.Image = None,
+             copies: int = PRINTER_COPIES) -> PrintJob:
+        # Job of a new picture, saved before being queued: the picture is
+        # always saved, even when it cannot be printed
+        name = save_picture(filename)
+        return PrintJob(join(PRINTER_OUT_DIRECTORY, name), name, image, copies)
+
+    def enqueue(self, job: PrintJob) -> PrintJob:
+        # Queues a new job, or a job again (its bitmap is reused)
+        job.error = None
+        job.failed_on = set()
+        job.submitted = time.perf_counter()
+        with self.condition:
+            if self._dispatch(job) is None:
+                errors = []
+                for worker in self.workers:
+                    worker.status.refresh()
+                    errors.append(worker.status.error)
+                raise RuntimeError(" / ".join(e for e in errors if e))
+        return job
 
-    # Map image size to page size
-    hdc.SetMapMode(win32con.MM_ISOTROPIC)
-    hdc.SetViewportExt((h_res, v_res))
-    hdc.SetWindowExt((img_width, img_height))
+    def reassign(self, worker: PrinterWorker, job: PrintJob) -> bool:
+        # Called by 'worker' when 'job' failed. False when no other printer
+        # can take the job, which has then failed.
+        with self.condition:
+            job.failed_on.add(worker)
+            waiting = list(worker.jobs)
+            worker.jobs.clear()
+            for other in waiting:
+                if self._dispatch(other, exclude=worker) is None:
+                    worker.jobs.append(other)
+            if self._dispatch(job) is None:
+                return False
+            job.error = None
+        metrics.record("printer.reassign", job.submitted,
+                       printer=worker.printer.name, moved=len(waiting))
+        return True
 
-    # Offset image so it is centered
-    offset_x = round((max_width - img_width) / 2)
-    offset_y = round((max_height - img_height) / 2)
-    hdc.SetWindowOrg((-offset_x, -offset_y))
+    def _dispatch(self, job: PrintJob, exclude: PrinterWorker = None):
+        # Queues the job on the printer expected to print it first, returns
+        # that printer (None if none is online). The lock must be held.
+        best, best_time = None, None
+        for worker in self.workers:
+            if (worker is exclude or worker in job.failed_on or
+                    not worker.online):
+                continue
+            done = (worker.backlog() +
+                    job.copies * worker.printer.print_duration)
+            if best is None or done < best_time:
+                best, best_time = worker, done
+        if best is not None:
+            job.worker = best
+            best.jobs.append(job)
+            self.condition.notify_all()
+        return best
 
-    # Make new document and write the image
-    hdc.StartDoc(name)
-    hdc.StartPage()
-    dib = ImageWin.Dib(img)
-    dib.draw(hdc.GetHandleOutput(), (0, 0, img_width, img_height))
-    hdc.EndPage()
-    hdc.EndDoc()
+    def position(self, job: PrintJob) -> int:
+        # Number of jobs to be printed before this one, on its printer
+        with self.condition:
+            worker = job.worker
+            if (worker is None or job is worker.current or
+                    job not in worker.jobs):
+                return 0
+            return worker.jobs.index(job) + (worker.current is not None)
 
-    # Delete the Device Context
-    hdc.DeleteDC()
+    def eta(self, job: PrintJob) -> float:
+        # Time until the job is printed (in seconds)
+        with self.condition:
+            worker = job.worker
+            if worker is None:
+                return 0.0
+            if job is not worker.current and job not in worker.jobs:
+                return max(0.0, worker.busy_until - time.monotonic())
+            return (worker.backlog(job) +
+                    job.copies * worker.printer.print_duration)
 
 
 def available_printer_names():
+    import win32print
     flags = win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS
     printers = win32print.EnumPrinters(flags)
     for _, _, name, _ in printers:
@@ -106,8 +444,11 @@ def available_printer_names():
 if __name__ == "__main__":
     try:
         n = save_picture()
-        check_printer()
-        print_picture(n)
+        archive.writer.flush()
+        p = create_printers()[0]
+        p.check()
+        with Image.open(join(PRINTER_OUT_DIRECTORY, n)) as i:
+            p.print_image(prepare_print_image(i, p.caps()), n)
     except Exception as e:
         print(str(e), file=sys.stderr)
         exit(-1)
@@ -0,0 +1,85 @@
+import importlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from metrics import metrics
+
+# Start of the booth: this module is the first one imported by main.py
+_origin = time.perf_counter()
+
+
+# Phases of the startup, for the startup report. Their start and end are
+# relative to the start of main.py, so that the phases run in parallel show up
+# side by side. They are recorded in the metrics too, to follow the startup
+# time across restarts. Phases can be recorded from any thread.
+class StartupProfile:
+    def __init__(self, origin: float):
+        self._origin = origin
+        self._phases = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, start: float = None):
+        # 'start' is a time.perf_counter() value (the start of main.py if
+        # None), the phase ends now
+        if start is None:
+            start = self._origin
+        end = time.perf_counter()
+        with self._lock:
+            self._phases.append((phase, (start - self._origin) * 1000,
+                                 (end - self._origin) * 1000,
+                                 threading.current_thread().name))
+        metrics.record("startup." + phase, start)
+
+    @contextmanager
+    def phase(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, start)
+
+    def run(self, phase: str, func):
+        with self.phase(phase):
+            return func()
+
+    def phases(self) -> list:
+        # (phase, start, end, thread) in the order they ended, in ms
+        with self._lock:
+            return sorted(self._phases, key=lambda phase: phase[2])
+
+    def report(self) -> str:
+        lines = ["{:<16} {:>10} {:>10} {:>10}  {}".format(
+            "phase", "from (ms)", "to (ms)", "took (ms)", "thread")]
+        for phase, start, end, thread in self.phases():
+            lines.append("{:<16} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(
+                phase, start, end, end - start, thread))
+        return "\n".join(lines)
+
+
+profile = StartupProfile(_origin)
+
+
+def warm_up(modules: list, tasks: dict, done):
+    # Imports the slow modules, then runs the slow initializations in
+    # parallel, all in the background and each timed as a phase of the
+    # startup. The modules are imported one after the other, importing a
+    # package from several threads at once can fail (NumPy does). 'done' is
+    # called from a background thread once the initializations are over,
+    # with their Future by name.
+    def run():
+        with profile.phase("modules"):
+            for module in modules:
+                try:
+                    importlib.import_module(module)
+                except ImportError as e:
+                    # Raised again by the initializations needing it
+                    print("Failed to import " + module + ": " + str(e),
+                          file=sys.stderr)
+        with ThreadPoolExecutor(len(tasks), "warm-up") as pool:
+            futures = {name: pool.submit(profile.run, name, task)
+                       for name, task in tasks.items()}
+        done(futures)
+
+    threading.Thread(target=run, name="warm-up", daemon=True).start()
@@ -0,0 +1,239 @@
+import threading
+import time
+import cv2
+import numpy as np
+from metrics import metrics
+from config import (WEBCAM_BACKEND, WEBCAM_FAKE_FPS, WEBCAM_BUFFER_COUNT,
+                    WEBCAM_CAPTURE_SIZE, WEBCAM_TARGET_FPS, WEBCAM_CPU_BUDGET)
+
+
+# Fake webcam, with the subset of the cv2.VideoCapture interface used here. It
+# delivers a few generated frames in a loop, at a steady frame rate.
+class FakeVideoCapture:
+    def __init__(self, fps: float = WEBCAM_FAKE_FPS, frame_count: int = 8):
+        self._interval = 1 / fps
+        self._frame_count = frame_count
+        self._size = (640, 480)
+        self._frames = None
+        self._index = 0
+        self._next_frame = 0.0
+
+    def isOpened(self) -> bool:
+        return True
+
+    def set(self, prop: int, value: float) -> bool:
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self._size = (int(value), self._size[1])
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self._size = (self._size[0], int(value))
+        else:
+            return False
+        self._frames = None
+        return True
+
+    def grab(self) -> bool:
+        # Waits for the next frame, like a real webcam
+        now = time.perf_counter()
+        if now < self._next_frame:
+            time.sleep(self._next_frame - now)
+        self._next_frame = max(now, self._next_frame) + self._interval
+        self._index += 1
+        return True
+
+    def retrieve(self, frame: np.ndarray = None):
+        if self._frames is None:
+            w, h = self._size
+            ramp = np.linspace(0, 255, w, dtype=np.uint8)
+            self._frames = [
+                np.dstack([np.roll(ramp, i * w // self._frame_count)[
+                    np.newaxis].repeat(h, axis=0)] * 3)
+                for i in range(self._frame_count)]
+        source = self._frames[self._index % self._frame_count]
+        if frame is None or frame.shape != source.shape:
+            return True, source.copy()
+        np.copyto(frame, source)
+        return True, frame
+
+    def release(self):
+        self._frames = None
+
+
+def create_video_capture(webcam_id: int, backend: str = WEBCAM_BACKEND):
+    if backend == "opencv":
+        return cv2.VideoCapture(webcam_id)
+    if backend == "fake":
+        return FakeVideoCapture()
+    raise ValueError("Unknown webcam backend: " + backend)
+
+
+def moving_average(average: float, value: float, count: int) -> float:
+    # Exponential moving average, over roughly the last 20 values
+    return average + (value - average) / min(count, 20)
+
+
+class WebcamStats:
+    def __init__(self):
+        # Frames grabbed from the webcam, and converted for the preview
+        self.grabs = 0
+        self.frames = 0
+        self.dropped = 0
+        self.skipped = 0
+        # Frame rate of the webcam, and of the preview
+        self.fps = 0.0
+        self.preview_fps = 0.0
+        # Average duration of the decoding and conversion of a frame (in
+        # seconds)
+        self.convert_time = 0.0
+        self._last_grab = None
+        self._last_frame = None
+
+    def restart(self):
+        # After a pause, which is not counted in the frame rates
+        self._last_grab = self._last_frame = None
+
+    def on_grab(self, grab_time: float):
+        if self._last_grab is not None and grab_time > self._last_grab:
+            self.fps = moving_average(
+                self.fps, 1 / (grab_time - self._last_grab), self.grabs)
+        self._last_grab = grab_time
+        self.grabs += 1
+
+    def on_frame(self, read_time: float, convert_time: float):
+        if self._last_frame is not None and read_time > self._last_frame:
+            self.preview_fps = moving_average(
+                self.preview_fps, 1 / (read_time - self._last_frame),
+                self.frames)
+        self._last_frame = read_time
+        self.frames += 1
+        self.convert_time = moving_average(self.convert_time, convert_time,
+                                           self.frames)
+
+    def __str__(self):
+        return ("{:.1f} fps, preview {:.1f} fps, conversion {:.1f} ms, "
+                "{} frames, {} dropped, {} skipped".format(
+                    self.fps, self.preview_fps, self.convert_time * 1000,
+                    self.frames, self.dropped, self.skipped))
+
+
+# Reads the webcam and converts the frames for the preview, in its own thread.
+# The converted frames are written in a ring of preallocated buffers: the
+# thread never writes in the latest frame nor in the one being displayed, and
+# a frame replaced before being displayed counts as dropped. Frames are kept in
+# BGR (Qt can display them as is) and mirrored, nothing is allocated per frame.
+# The frame rate is limited to WEBCAM_TARGET_FPS, and reduced further when the
+# conversion uses more than WEBCAM_CPU_BUDGET: the frames in excess are grabbed
+# but not decoded. While paused, the webcam stays open but is not read.
+class WebcamCapture(threading.Thread):
+    def __init__(self, webcam_id: int, size: tuple):
+        super().__init__(daemon=True)
+        self._webcam_id = webcam_id
+        self._size = size
+        self._capture = None
+        self._running = True
+        self._active = threading.Event()
+        self._active.set()
+        self._next_frame = 0.0
+        self._frame = None
+        self.buffers = [np.empty((size[1], size[0], 3), np.uint8)
+                        for _ in range(max(3, WEBCAM_BUFFER_COUNT))]
+        self._resized = np.empty((size[1], size[0], 3), np.uint8)
+        self._lock = threading.Lock()
+        self._latest = None
+        self._displayed = None
+        self._consumed = True
+        self.stats = WebcamStats()
+        # Counters at the previous record_stats()
+        self._recorded = (0, 0, 0, 0)
+
+    def open(self) -> bool:
+        self._capture = create_video_capture(self._webcam_id)
+        if WEBCAM_CAPTURE_SIZE is not None:
+            # The webcam picks its closest resolution, the resize can then be
+            # skipped or at least be cheaper
+            self._capture.set(cv2.CAP_PROP_FRAME_WIDTH, WEBCAM_CAPTURE_SIZE[0])
+            self._capture.set(cv2.CAP_PROP_FRAME_HEIGHT,
+                              WEBCAM_CAPTURE_SIZE[1])
+        return self._capture.isOpened()
+
+    def stop(self):
+        self._running = False
+        self._active.set()
+        self.join()
+
+    def record_stats(self):
+        # Rates and conversion time in the metrics, with the counters since
+        # the previous call. The span lasts the average conversion time.
+        stats = self.stats
+        counters = (stats.grabs, stats.frames, stats.dropped, stats.skipped)
+        grabs, frames, dropped, skipped = (
+            now - before for now, before in zip(counters, self._recorded))
+        self._recorded = counters
+        if grabs == 0:
+            return
+        metrics.record("webcam.convert",
+                       time.perf_counter() - stats.convert_time,
+                       fps=round(stats.fps, 1),
+                       preview_fps=round(stats.preview_fps, 1), grabs=grabs,
+                       frames=frames, dropped=dropped, skipped=skipped)
+
+    def pause(self):
+        self._active.clear()
+
+    def resume(self):
+        self._active.set()
+
+    def acquire(self):
+        # Index in 'buffers' of the latest frame if not displayed yet (or
+        # None). It stays untouched until the next frame is acquired.
+        with self._lock:
+            if self._consumed or self._latest is None:
+                return None
+            self._consumed = True
+            self._displayed = self._latest
+            return self._displayed
+
+    def _free_buffer(self) -> int:
+        with self._lock:
+            for i in range(len(self.buffers)):
+                if i != self._latest and i != self._displayed:
+                    return i
+
+    def _publish(self, index: int):
+        with self._lock:
+            if not self._consumed:
+                self.stats.dropped += 1
+            self._latest = index
+            self._consumed = False
+
+    def run(self):
+        while self._running:
+            if not self._active.is_set():
+                self._active.wait()
+                self.stats.restart()
+            if not self._capture.grab():
+                break
+            read_time = time.perf_counter()
+            self.stats.on_grab(read_time)
+            if read_time < self._next_frame:
+                self.stats.skipped += 1
+                continue
+            is_reading, self._frame = self._capture.retrieve(self._frame)
+            if not is_reading:
+                break
+            index = self._free_buffer()
+            self._convert(self._frame, self.buffers[index])
+            self.stats.on_frame(read_time, time.perf_counter() - read_time)
+            self._publish(index)
+            self._next_frame = read_time + self._frame_interval()
+        self._capture.release()
+        print("Webcam stopped: " + str(self.stats))
+
+    def _frame_interval(self) -> float:
+        return max(1 / WEBCAM_TARGET_FPS,
+                   self.stats.convert_time / WEBCAM_CPU_BUDGET)
+
+    def _convert(self, frame: np.ndarray, out: np.ndarray):
+        if frame.shape != out.shape:
+            frame = cv2.resize(frame, self._size, dst=self._resized,
+                               interpolation=cv2.INTER_AREA)
+        cv2.flip(frame, 1, dst=out)
@@ -0,0 +1,37 @@
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QFrame,
+                             QGraphicsDropShadowEffect, QLabel)
+from PyQt5.QtCore import Qt, QSize
+from config import PREVIEW_SIZE
+
+
+def apply_shadow(widget: QWidget, radius: float):
+    shadow = QGraphicsDropShadowEffect()
+    shadow.setBlurRadius(radius)
+    shadow.setColor(Qt.black)
+    shadow.setOffset(0, 0)
+    widget.setGraphicsEffect(shadow)
+
+
+def apply_font(widget: QWidget, size: int, bold: bool = False,
+               italic: bool = False):
+    f = widget.font()
+    f.setFamily("Century Gothic")
+    f.setBold(bold)
+    f.setItalic(italic)
+    f.setPixelSize(size)
+    widget.setFont(f)
+
+
+class CentralWidget(QFrame):
+    def __init__(self, parent, label_class=QLabel):
+        super().__init__(parent)
+        self.setObjectName("CentralWidget")
+        self._size = QSize(*PREVIEW_SIZE)
+        apply_shadow(self, 100)
+        self._img = label_class(self)
+        self._img.setAlignment(Qt.AlignCenter)
+        self._img.setFixedSize(self._size)
+        grid = QVBoxLayout()
+        grid.setContentsMargins(5, 5, 5, 5)
+        grid.addWidget(self._img)
+        self.setLayout(grid)